@@ -1,30 +1,55 @@
 # -*- coding: utf-8 -*-
 from gevent import monkey
 monkey.patch_all()
+import gevent
 
 import os
 import sys
+import csv
 import random
-
-# Wymuszenie UTF-8 dla całej aplikacji
-if sys.version_info[0] >= 3:
-    import io
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
-from flask import Flask, render_template, request, jsonify, url_for, session, redirect
+import re
+import json
+import hashlib
+import unicodedata
+import heapq
+import bisect
+import socket
+import threading
+import queue
+import itertools
+import uuid
+from collections import defaultdict
+
+# Wymuszenie UTF-8 dla całej aplikacji (reconfigure zamiast nowego TextIOWrapper - zachowuje buforowanie strumieni)
+for _stream in (sys.stdout, sys.stderr):
+    if hasattr(_stream, 'reconfigure') and (_stream.encoding or '').lower() != 'utf-8':
+        _stream.reconfigure(encoding='utf-8')
+from flask import Flask, render_template, request, jsonify, url_for, session, redirect, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO, emit, join_room
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.formparser import parse_form_data
+from werkzeug.exceptions import RequestEntityTooLarge
 from functools import wraps
-import anthropic
+from sqlalchemy.orm.attributes import set_committed_value
+import click
 
 # Inicjalizacja
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'bardzo-tajny-klucz-super-bezpieczny')
 app.config['UPLOAD_FOLDER'] = 'static/uploads/logos'
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 # 2MB limit
+# Co ile sekund serwer wysyła timer_tick (klienci odliczają czas lokalnie między synchronizacjami)
+app.config['TIMER_SYNC_INTERVAL'] = max(1, int(os.environ.get('TIMER_SYNC_INTERVAL', 10)))
+# Co ile delt rankingu wysyłany jest pełny snapshot (leaderboard_update)
+app.config['LEADERBOARD_SNAPSHOT_EVERY'] = max(1, int(os.environ.get('LEADERBOARD_SNAPSHOT_EVERY', 50)))
+# Domyślne okno łączenia emisji rankingu/hasła w ms (per event: klucz stanu 'emit_coalesce_ms')
+app.config['EMIT_COALESCE_MS'] = max(0, int(os.environ.get('EMIT_COALESCE_MS', 300)))
+# Szybki start (Fly.io z auto_stop_machines): bez tworzenia schematu i wpisów domyślnych przy imporcie -
+# wykonuje je jednorazowo `flask init-db` (np. jako release_command)
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', 'False').lower() == 'true'
 
 # Tworzenie folderów na pliki
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -44,7 +69,11 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
 # Konfiguracja SocketIO
+# SOCKETIO_MESSAGE_QUEUE (np. redis://localhost:6379/0) włącza tryb wielu workerów/maszyn:
+# emisje do pokojów event_{id} trafiają do klientów podłączonych do dowolnego procesu
+message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
 socketio = SocketIO(app, 
+                    message_queue=message_queue,
                     async_mode='gevent', 
                     cors_allowed_origins="*", 
                     manage_session=True,
@@ -83,13 +112,21 @@ class Player(db.Model):
     warnings = db.Column(db.Integer, default=0)
     revealed_letters = db.Column(db.String(100), default='')
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    __table_args__ = (
+        db.Index('ix_player_event_score', 'event_id', 'score'),
+        db.Index('ix_player_event_name', 'event_id', 'name'),
+    )
 
 class PlayerAnswer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='CASCADE'), nullable=False)
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
-    
+    __table_args__ = (
+        db.Index('ix_player_answer_player_question', 'player_id', 'question_id'),
+        db.Index('ix_player_answer_event_question', 'event_id', 'question_id'),
+    )
+
 class Question(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(255), nullable=False)
@@ -103,6 +140,7 @@ class Question(db.Model):
     difficulty = db.Column(db.String(20), nullable=False, default='easy')
     times_shown = db.Column(db.Integer, default=0)
     times_correct = db.Column(db.Integer, default=0)
+    __table_args__ = (db.Index('ix_question_event_category', 'event_id', 'category'),)
 
 class QRCode(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -110,6 +148,10 @@ class QRCode(db.Model):
     color = db.Column(db.String(20), nullable=False, default='white')
     claimed_by_player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=True)
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    __table_args__ = (
+        db.Index('ix_qr_code_event_identifier', 'event_id', 'code_identifier', unique=True),
+        db.Index('ix_qr_code_event_color', 'event_id', 'color'),
+    )
 
 class PlayerScan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -118,6 +160,10 @@ class PlayerScan(db.Model):
     scan_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
     color_category = db.Column(db.String(20), nullable=True)
+    __table_args__ = (
+        db.Index('ix_player_scan_player_color_time', 'player_id', 'color_category', 'scan_time'),
+        db.Index('ix_player_scan_event', 'event_id'),
+    )
 
 class FunnyPhoto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -127,6 +173,22 @@ class FunnyPhoto(db.Model):
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     votes = db.Column(db.Integer, default=0)
+    __table_args__ = (
+        db.Index('ix_funny_photo_event_votes', 'event_id', 'votes', 'timestamp'),
+        db.Index('ix_funny_photo_player', 'player_id'),
+    )
+
+class FunnyPhotoVariant(db.Model):
+    """Wersja zdjęcia o danej szerokości (WebP) - generowana raz przy uploadzie, nigdy nie zmieniana"""
+    id = db.Column(db.Integer, primary_key=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('funny_photo.id', ondelete='CASCADE'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    url = db.Column(db.String(255), nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('photo_id', 'width', name='_photo_variant_width_uc'),
+        db.Index('ix_funny_photo_variant_event', 'event_id'),
+    )
 
 class PhotoVote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -134,7 +196,25 @@ class PhotoVote(db.Model):
     player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('photo_id', 'player_id', name='_photo_player_vote_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('photo_id', 'player_id', name='_photo_player_vote_uc'),
+        db.Index('ix_photo_vote_event', 'event_id'),
+        db.Index('ix_photo_vote_player', 'player_id', 'event_id'),
+    )
+
+class ScoreAward(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False)
+    delta = db.Column(db.Integer, default=0)
+    score = db.Column(db.Integer, nullable=True)
+    response = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'idempotency_key', name='_player_idempotency_key_uc'),
+        db.Index('ix_score_award_event', 'event_id'),
+    )
 
 class GameState(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -143,6 +223,20 @@ class GameState(db.Model):
     value = db.Column(db.String(255), nullable=False)
     __table_args__ = (db.UniqueConstraint('event_id', 'key', name='_event_key_uc'),)
 
+class QuestionDeck(db.Model):
+    """Potasowana kolejka pytań gracza w kategorii - następne pytanie to question_ids[position]"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    question_ids = db.Column(db.Text, nullable=False, default='')  # "12,7,33"
+    position = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0)  # question_set_version z chwili tasowania
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'category', name='_player_category_deck_uc'),
+        db.Index('ix_question_deck_event', 'event_id'),
+    )
+
 # --- AI Quiz Models ---
 class AIQuizCategory(db.Model):
     """Kategorie dla AI Quiz - 10 domyślnych + custom od Hosta"""
@@ -155,6 +249,7 @@ class AIQuizCategory(db.Model):
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=True)  # NULL dla domyślnych
     created_by_api = db.Column(db.Boolean, default=False)  # Czy pytania generowane przez Claude API
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_ai_quiz_category_event_active', 'event_id', 'is_active'),)
 
 class AIQuestion(db.Model):
     """Pytania AI - edytowalne przez Admina"""
@@ -169,6 +264,8 @@ class AIQuestion(db.Model):
     times_shown = db.Column(db.Integer, default=0)
     times_correct = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    source_key = db.Column(db.String(40), nullable=True)  # klucz importu z treści pytania - edycja go nie zmienia
+    __table_args__ = (db.Index('ix_ai_question_category', 'category_id'),)
 
 class AIPlayerAnswer(db.Model):
     """Odpowiedzi graczy na pytania AI - żeby pytania się nie powtarzały"""
@@ -177,57 +274,185 @@ class AIPlayerAnswer(db.Model):
     ai_question_id = db.Column(db.Integer, db.ForeignKey('ai_question.id', ondelete='CASCADE'), nullable=False)
     event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
     answered_at = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('player_id', 'ai_question_id', name='_ai_player_question_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'ai_question_id', name='_ai_player_question_uc'),
+        db.Index('ix_ai_player_answer_player_event', 'player_id', 'event_id'),
+        db.Index('ix_ai_player_answer_event', 'event_id'),
+    )
 
-# Inicjalizacja bazy danych przy starcie aplikacji
-with app.app_context():
-    try:
-        db.create_all()
-        if not Admin.query.first():
-            admin = Admin(login='admin')
-            admin.set_password('admin')
-            db.session.add(admin)
-            print("Default admin created.")
-        
-        if not Event.query.first():
-            event = Event(id=1, login='host1', name='Event #1', password_plain='password1')
-            event.set_password('password1')
-            db.session.add(event)
-            print("Default event created.")
-
-        # Inicjalizacja 10 domyślnych kategorii AI Quiz
-        if AIQuizCategory.query.filter_by(is_default=True).count() == 0:
-            default_categories = [
-                'Historia powszechna',
-                'Geografia',
-                'Znane postaci',
-                'Muzyka',
-                'Literatura',
-                'Kuchnia',
-                'Film',
-                'Nauki ścisłe',
-                'Historia Polski',
-                'Sport'
-            ]
-            for cat_name in default_categories:
-                category = AIQuizCategory(
-                    name=cat_name,
-                    difficulty='medium',
-                    is_active=True,
-                    is_default=True,
-                    is_custom=False,
-                    event_id=None,
-                    created_by_api=False
-                )
-                db.session.add(category)
-            print("Default AI Quiz categories created.")
+class AIQuestionDeck(db.Model):
+    """Potasowana kolejka pytań AI gracza w kategorii - jak QuestionDeck"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('ai_quiz_category.id', ondelete='CASCADE'), nullable=False)
+    question_ids = db.Column(db.Text, nullable=False, default='')
+    position = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'category_id', name='_player_ai_category_deck_uc'),
+        db.Index('ix_ai_question_deck_event', 'event_id'),
+        db.Index('ix_ai_question_deck_category', 'category_id'),
+    )
 
-        db.session.commit()
-        print("Database tables checked/created successfully.")
-    except Exception as e:
-        print(f"Database initialization error: {e}")
+class AIGenerationJob(db.Model):
+    """Zadanie generowania pytań przez Claude API w tle (queued -> running -> done/failed)"""
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('ai_quiz_category.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    requested = db.Column(db.Integer, nullable=False, default=10)
+    generated = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    owner = db.Column(db.String(100), nullable=True)  # _cluster_node_id() procesu, który wykonuje zadanie
+    lease_until = db.Column(db.DateTime, nullable=True)  # odświeżane w trakcie - po upływie zadanie można przejąć
+    __table_args__ = (
+        db.Index('ix_ai_generation_job_event', 'event_id'),
+        db.Index('ix_ai_generation_job_status', 'status'),
+    )
+
+class AIQuestionPool(db.Model):
+    """Pula wygenerowanych pytań AI do ponownego użycia między eventami (klucz: temat + trudność)"""
+    id = db.Column(db.Integer, primary_key=True)
+    topic_key = db.Column(db.String(150), nullable=False)  # np. "historia polski|medium"
+    question_text = db.Column(db.String(500), nullable=False)
+    option_a = db.Column(db.String(200), nullable=False)
+    option_b = db.Column(db.String(200), nullable=False)
+    option_c = db.Column(db.String(200), nullable=False)
+    correct_answer = db.Column(db.String(1), nullable=False)
+    fingerprint = db.Column(db.BigInteger, nullable=False)  # simhash treści pytania
+    answer_key = db.Column(db.String(200), nullable=False)  # znormalizowana poprawna odpowiedź
+    times_used = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_ai_question_pool_topic', 'topic_key', 'times_used'),)
+
+# --- Migracje ---
+def ensure_columns():
+    """Dodaje brakujące kolumny z wartością NULL do istniejących tabel (create_all ich nie dodaje)"""
+    inspector = db.inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(db.text(
+                        f'ALTER TABLE {quote.format_table(table)} ADD COLUMN {quote.format_column(column)} {column_type}'))
+                added.append(f'{table.name}.{column.name}')
+            except Exception as e:
+                print(f"❌ Nie udało się dodać kolumny {table.name}.{column.name}: {e}")
+    if added:
+        print(f"🗂️ Added columns: {', '.join(added)}")
+    return added
+
+def _rebuild_index(index, existing):
+    """Przebudowuje indeks o tej samej nazwie, ale bez/z UNIQUE.
+
+    Nowy indeks powstaje najpierw pod tymczasową nazwą - jeśli się nie uda (np. UNIQUE przy
+    duplikatach w tabeli), stary zostaje na miejscu. Dopiero potem stary jest zamieniany na nowy.
+    """
+    table = index.table
+    temporary = db.Index(f'{index.name}_tmp', *index.columns, unique=index.unique)
+    table.indexes.discard(temporary)  # tylko na czas przebudowy, nie w metadanych modelu
+    if temporary.name in existing:
+        temporary.drop(bind=db.engine)  # pozostałość po przerwanej przebudowie
+    temporary.create(bind=db.engine)
+    index.drop(bind=db.engine)
+    index.create(bind=db.engine)
+    temporary.drop(bind=db.engine)
+
+def ensure_indexes():
+    """Tworzy brakujące indeksy na istniejących bazach (create_all pomija tabele, które już istnieją)"""
+    inspector = db.inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name']: bool(index['unique']) for index in inspector.get_indexes(table.name)}
+        for index in list(table.indexes):
+            if existing.get(index.name) == bool(index.unique):
+                continue
+            try:
+                if index.name in existing:
+                    _rebuild_index(index, existing)
+                else:
+                    index.create(bind=db.engine)
+                created.append(index.name)
+            except Exception as e:
+                hint = ' (duplikaty w tabeli? stary indeks zostaje)' if index.unique and index.name in existing else ''
+                print(f"❌ Nie udało się utworzyć indeksu {index.name}{hint}: {e}")
+    if created:
+        print(f"🗂️ Created indexes: {', '.join(created)}")
+    return created
+
+def init_database():
+    """Tworzy tabele, brakujące indeksy i domyślne wpisy (admin, event, kategorie AI), jeśli nie istnieją"""
+    db.create_all()
+    ensure_columns()
+    ensure_indexes()
+    if not Admin.query.first():
+        admin = Admin(login='admin')
+        admin.set_password('admin')
+        db.session.add(admin)
+        print("Default admin created.")
+
+    if not Event.query.first():
+        event = Event(id=1, login='host1', name='Event #1', password_plain='password1')
+        event.set_password('password1')
+        db.session.add(event)
+        print("Default event created.")
+
+    # Inicjalizacja 10 domyślnych kategorii AI Quiz
+    if AIQuizCategory.query.filter_by(is_default=True).count() == 0:
+        default_categories = [
+            'Historia powszechna',
+            'Geografia',
+            'Znane postaci',
+            'Muzyka',
+            'Literatura',
+            'Kuchnia',
+            'Film',
+            'Nauki ścisłe',
+            'Historia Polski',
+            'Sport'
+        ]
+        for cat_name in default_categories:
+            category = AIQuizCategory(
+                name=cat_name,
+                difficulty='medium',
+                is_active=True,
+                is_default=True,
+                is_custom=False,
+                event_id=None,
+                created_by_api=False
+            )
+            db.session.add(category)
+        print("Default AI Quiz categories created.")
+
+    db.session.commit()
+
+# Inicjalizacja bazy danych przy starcie aplikacji (w trybie LAZY_STARTUP tylko przez `flask init-db`)
+if not LAZY_STARTUP:
+    with app.app_context():
+        try:
+            init_database()
+            print("Database tables checked/created successfully.")
+        except Exception as e:
+            print(f"Database initialization error: {e}")
 
 
+@app.context_processor
+def inject_socketio_options():
+    # W trybie wielu workerów tylko WebSocket - long-polling wymagałby sticky sessions
+    return {'socketio_client_options': {'transports': ['websocket']} if message_queue else {}}
+
 # --- Dekoratory Autoryzacji ---
 def admin_required(f):
     @wraps(f)
@@ -253,82 +478,284 @@ def host_required(f):
 @app.cli.command("init-db")
 def init_db_command():
     """Tworzy tabele w bazie danych i domyślne wpisy, jeśli nie istnieją."""
-    db.create_all()
-    if not Admin.query.first():
-        admin = Admin(login='admin')
-        admin.set_password('admin')
-        db.session.add(admin)
-    if not Event.query.first():
-        event = Event(id=1, login='host1', name='Event #1')
-        event.set_password('password1')
-        db.session.add(event)
-    db.session.commit()
+    init_database()
     print("Database initialized.")
 
+@app.cli.command("load-ai-questions")
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--seed/--no-seed', default=None, help='Wbudowany ai_questions_seed (domyślnie tylko bez paczek).')
+@click.option('--create-categories', is_flag=True, help='Twórz brakujące kategorie domyślne z paczek.')
+def load_ai_questions_command(paths, seed, create_categories):
+    """Ładuje pytania AI z seed i/lub paczek .json/.jsonl/.csv (kolumny: category,q,a,b,c,correct,difficulty)."""
+    sources = []
+    if seed or (seed is None and not paths):
+        sources.append(iter_seed_records())
+    sources.extend(iter_pack_records(path) for path in paths)
+    stats = bulk_load_ai_questions(itertools.chain.from_iterable(sources), create_categories=create_categories)
+    print(f"Loaded {stats['loaded']} questions (duplicates: {stats['duplicates']}, invalid: {stats['invalid']}, "
+          f"unknown category: {stats['unknown_category']}, categories created: {stats['categories_created']}).")
+
 
 # --- Funkcje Pomocnicze ---
+
+# Cache stanu gry: event_id -> {key: value}
+# Wszystkie wiersze GameState eventu są ładowane jednym zapytaniem, odczyty idą z pamięci,
+# a zapisy trafiają jednocześnie do cache i do bazy (write-through).
+_game_state_cache = {}
+
+def _state_event_id(event_id):
+    """Normalizuje event_id (z JSON/Socket.IO może przyjść jako string)"""
+    try:
+        return int(event_id)
+    except (TypeError, ValueError):
+        return event_id
+
+def _load_game_state(event_id):
+    event_id = _state_event_id(event_id)
+    state = _game_state_cache.get(event_id)
+    if state is None:
+        rows = db.session.query(GameState.key, GameState.value).filter_by(event_id=event_id).all()
+        state = {key: value for key, value in rows}
+        _game_state_cache[event_id] = state
+    return state
+
+def invalidate_game_state(event_id=None):
+    """Usuwa stan eventu z cache (lub cały cache) - wywoływać po masowym usunięciu GameState"""
+    _drop_game_state(event_id)
+    publish_cluster_event('state', event_id)
+
+def _drop_game_state(event_id):
+    if event_id is None:
+        _game_state_cache.clear()
+    else:
+        _game_state_cache.pop(_state_event_id(event_id), None)
+
+def _game_state_upsert(event_id, values):
+    """Buduje jedno zapytanie INSERT ... ON CONFLICT DO UPDATE (SQLite/PostgreSQL)"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(GameState.__table__).values([
+        {'event_id': event_id, 'key': key, 'value': value} for key, value in values.items()
+    ])
+    return stmt.on_conflict_do_update(
+        index_elements=['event_id', 'key'],
+        set_={'value': stmt.excluded.value}
+    )
+
+def stage_game_states(event_id, values):
+    """Zapisuje klucze stanu gry w bieżącej transakcji, bez commita.
+
+    Po commicie wywołującego trzeba wywołać apply_game_states z tym samym event_id
+    i zwróconym słownikiem - dopiero wtedy zmiana trafia do cache i innych procesów.
+    """
+    values = {key: str(value) for key, value in values.items()}
+    if not values:
+        return values
+    event_id = _state_event_id(event_id)
+    state = _load_game_state(event_id)
+    upsert = _game_state_upsert(event_id, values)
+    if upsert is not None:
+        db.session.execute(upsert)
+    else:
+        updates = [{'k': key, 'v': value} for key, value in values.items() if key in state]
+        inserts = [{'event_id': event_id, 'key': key, 'value': value} for key, value in values.items() if key not in state]
+        if updates:
+            db.session.execute(
+                GameState.__table__.update()
+                .where(GameState.event_id == event_id, GameState.key == db.bindparam('k'))
+                .values(value=db.bindparam('v')),
+                updates
+            )
+        if inserts:
+            db.session.execute(GameState.__table__.insert(), inserts)
+    return values
+
+def apply_game_states(event_id, values):
+    """Przenosi zatwierdzone zmiany stanu gry do cache i powiadamia pozostałe procesy"""
+    if not values:
+        return
+    event_id = _state_event_id(event_id)
+    _load_game_state(event_id).update(values)
+    publish_cluster_event('state', event_id)
+
+def set_game_states(event_id, values):
+    """Zapisuje wiele kluczy stanu gry jednym zapytaniem i jednym commitem.
+
+    Commit obejmuje też inne oczekujące zmiany w sesji, więc całość
+    (np. usunięcie graczy + nowy stan gry) trafia do bazy w jednej transakcji.
+    """
+    try:
+        values = stage_game_states(event_id, values)
+        if not values:
+            return
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        invalidate_game_state(event_id)
+        raise
+    apply_game_states(event_id, values)
+
 def get_game_state(event_id, key, default=None):
-    state = GameState.query.filter_by(event_id=event_id, key=key).first()
-    return state.value if state else default
+    return _load_game_state(event_id).get(key, default)
 
 def set_game_state(event_id, key, value):
-    state = GameState.query.filter_by(event_id=event_id, key=key).first()
-    if state: state.value = str(value)
-    else: db.session.add(GameState(event_id=event_id, key=key, value=str(value)))
-    db.session.commit()
+    set_game_states(event_id, {key: value})
+
+# --- Silnik czasu gry ---
+# Pozostały czas liczony jest analitycznie z bieżącego segmentu prędkości:
+#   timer_segment_start - moment (UTC) rozpoczęcia segmentu
+#   timer_segment_left  - sekundy gry pozostałe na początku segmentu
+#   time_speed          - mnożnik prędkości w segmencie
+# game_end_time to rzeczywisty moment końca gry przy bieżącej prędkości.
+# Baza jest zapisywana tylko przy starcie, pauzie, wznowieniu, zmianie prędkości i zmianie czasu.
+
+def timer_segment(time_left, speed, now):
+    """Zwraca klucze stanu dla nowego segmentu czasu rozpoczynającego się w `now`"""
+    time_left = max(0.0, float(time_left))
+    return {
+        'timer_segment_start': now.isoformat(),
+        'timer_segment_left': time_left,
+        'time_speed': speed,
+        'game_end_time': (now + timedelta(seconds=time_left / max(speed, 1))).isoformat()
+    }
 
-def get_full_game_state(event_id):
-    # Pobierz podstawowe dane o stanie gry
+def compute_time_left(event_id, now=None):
+    """Pozostały czas gry (w sekundach gry) wyliczony z bieżącego segmentu"""
+    if get_game_state(event_id, 'game_active', 'False') != 'True':
+        return 0
+    now = now or datetime.utcnow()
+    try:
+        if get_game_state(event_id, 'is_timer_running', 'False') != 'True':
+            pause_left = get_game_state(event_id, 'time_left_on_pause')
+            if pause_left is not None:
+                return max(0.0, float(pause_left))
+        segment_start = get_game_state(event_id, 'timer_segment_start')
+        if segment_start:
+            segment_left = float(get_game_state(event_id, 'timer_segment_left', 0))
+            speed = int(get_game_state(event_id, 'time_speed', 1))
+            elapsed = (now - datetime.fromisoformat(segment_start)).total_seconds()
+            return max(0.0, segment_left - elapsed * speed)
+        # Gra rozpoczęta przed wprowadzeniem segmentów
+        end_time_str = get_game_state(event_id, 'game_end_time')
+        if end_time_str:
+            return max(0.0, (datetime.fromisoformat(end_time_str) - now).total_seconds())
+    except (ValueError, TypeError):
+        pass
+    return 0
+
+def compute_elapsed_times(event_id, now=None):
+    """Zwraca czas gry netto (bez pauz) i brutto (z pauzami) w sekundach"""
+    start_time_str = get_game_state(event_id, 'game_start_time')
+    if not start_time_str:
+        return 0, 0
+    now = now or datetime.utcnow()
+    try:
+        start_time = datetime.fromisoformat(start_time_str)
+        time_elapsed_with_pauses = (now - start_time).total_seconds()
+        
+        # Odejmij czas pauz dla czasu netto
+        total_paused = float(get_game_state(event_id, 'total_paused_duration', 0))
+        time_elapsed = time_elapsed_with_pauses - total_paused
+        
+        # Jeśli aktualnie w pauzie, odejmij też czas od rozpoczęcia pauzy
+        is_active = get_game_state(event_id, 'game_active', 'False') == 'True'
+        is_timer_running = get_game_state(event_id, 'is_timer_running', 'False') == 'True'
+        if is_active and not is_timer_running:
+            pause_start_str = get_game_state(event_id, 'pause_start_time')
+            if pause_start_str:
+                pause_start = datetime.fromisoformat(pause_start_str)
+                time_elapsed -= (now - pause_start).total_seconds()
+        return time_elapsed, time_elapsed_with_pauses
+    except (ValueError, AttributeError):
+        return 0, 0
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _epoch_ms(dt):
+    return int((dt - _EPOCH).total_seconds() * 1000)
+
+def timer_sync_payload(event_id, now=None):
+    """Dane zegara do lokalnego odliczania po stronie klienta.
+
+    game_end_timestamp to rzeczywisty moment końca gry (ms od epoki, zegar serwera),
+    server_time pozwala klientowi wyliczyć przesunięcie swojego zegara.
+    """
+    now = now or datetime.utcnow()
     is_active = get_game_state(event_id, 'game_active', 'False') == 'True'
     is_timer_running = get_game_state(event_id, 'is_timer_running', 'False') == 'True'
+    time_speed = int(get_game_state(event_id, 'time_speed', 1))
+    time_left = compute_time_left(event_id, now) if is_active else 0
+    time_elapsed, time_elapsed_with_pauses = compute_elapsed_times(event_id, now)
     
-    # Oblicz pozostały czas
-    time_left = 0
-    if is_active:
-        end_time_str = get_game_state(event_id, 'game_end_time')
-        if end_time_str:
-            try:
-                end_time = datetime.fromisoformat(end_time_str)
-                time_left = max(0, (end_time - datetime.utcnow()).total_seconds())
-            except (ValueError, AttributeError):
-                time_left = 0
+    game_end_timestamp = None
+    if is_active and is_timer_running:
+        game_end_timestamp = _epoch_ms(now + timedelta(seconds=time_left / max(time_speed, 1)))
     
-    # Oblicz czas gry (netto i brutto)
-    time_elapsed = 0
-    time_elapsed_with_pauses = 0
+    return {
+        'game_active': is_active,
+        'is_timer_running': is_timer_running,
+        'time_left': time_left,
+        'time_elapsed': time_elapsed,
+        'time_elapsed_with_pauses': time_elapsed_with_pauses,
+        'time_speed': time_speed,
+        'server_time': _epoch_ms(now),
+        'game_end_timestamp': game_end_timestamp
+    }
+
+def get_event_counters(event_id):
+    """Zwraca (liczba graczy, liczba pytań, liczba różnych odpowiedzianych pytań, liczba odpowiedzi)
+    jednym zapytaniem z podzapytaniami skalarnymi"""
+    event_id = _state_event_id(event_id)
+    return tuple(db.session.query(
+        db.select(db.func.count(Player.id)).where(Player.event_id == event_id).scalar_subquery(),
+        db.select(db.func.count(Question.id)).where(Question.event_id == event_id).scalar_subquery(),
+        db.select(db.func.count(db.distinct(PlayerAnswer.question_id))).where(PlayerAnswer.event_id == event_id).scalar_subquery(),
+        db.select(db.func.count(PlayerAnswer.id)).where(PlayerAnswer.event_id == event_id).scalar_subquery()
+    ).one())
+
+def get_displayed_password(event_id):
+    """Hasło z odkrytymi literami (nieodkryte jako '_', spacje podwójnie)"""
+    # ✅ Generowanie hasła na podstawie indeksów
+    password_value = get_game_state(event_id, 'game_password', 'SAPEREVENT')
+    revealed_indices_str = get_game_state(event_id, 'revealed_password_indices', '')
     
-    start_time_str = get_game_state(event_id, 'game_start_time')
-    if start_time_str:
+    # Parsuj indeksy
+    revealed_indices = set()
+    if revealed_indices_str:
         try:
-            start_time = datetime.fromisoformat(start_time_str)
-            time_elapsed_with_pauses = (datetime.utcnow() - start_time).total_seconds()
-            
-            # Odejmij czas pauz dla czasu netto
-            total_paused = float(get_game_state(event_id, 'total_paused_duration', 0))
-            time_elapsed = time_elapsed_with_pauses - total_paused
-            
-            # Jeśli aktualnie w pauzie, dodaj czas od rozpoczęcia pauzy
-            if is_active and not is_timer_running:
-                pause_start_str = get_game_state(event_id, 'pause_start_time')
-                if pause_start_str:
-                    pause_start = datetime.fromisoformat(pause_start_str)
-                    current_pause_duration = (datetime.utcnow() - pause_start).total_seconds()
-                    time_elapsed = time_elapsed_with_pauses - total_paused - current_pause_duration
+            revealed_indices = set(map(int, revealed_indices_str.split(',')))
         except (ValueError, AttributeError):
-            time_elapsed = 0
-            time_elapsed_with_pauses = 0
+            revealed_indices = set()
     
-    # Liczba graczy
-    player_count = Player.query.filter_by(event_id=event_id).count()
+    # Generuj displayed_password
+    displayed_password = ""
+    for i, char in enumerate(password_value):
+        if char == ' ':
+            displayed_password += '  '
+        elif i in revealed_indices:
+            displayed_password += char
+        else:
+            displayed_password += '_'
+    return displayed_password
+
+def get_full_game_state(event_id):
+    # Pobierz podstawowe dane o stanie gry i zegar
+    timer = timer_sync_payload(event_id)
+    is_active = timer['game_active']
+    is_timer_running = timer['is_timer_running']
+    start_time_str = get_game_state(event_id, 'game_start_time')
+    
+    # Liczniki eventu (jedno zapytanie)
+    player_count, total_questions, answered_questions, correct_answers = get_event_counters(event_id)
     
     # Procent ukończenia
-    total_questions = Question.query.filter_by(event_id=event_id).count()
-    answered_questions = PlayerAnswer.query.filter_by(event_id=event_id).distinct(PlayerAnswer.question_id).count()
     completion_percentage = int((answered_questions / total_questions * 100)) if total_questions > 0 else 0
     
-    # Liczba poprawnych odpowiedzi
-    correct_answers = PlayerAnswer.query.filter_by(event_id=event_id).count()
-    
     # Status gry
     game_status = 'waiting'
     if is_active:
@@ -343,49 +770,95 @@ def get_full_game_state(event_id):
     language_player = get_game_state(event_id, 'language_player', 'pl')
     language_host = get_game_state(event_id, 'language_host', 'pl')
     
-    # Bonus i prędkość
+    # Bonus
     bonus_multiplier = int(get_game_state(event_id, 'bonus_multiplier', 1))
-    time_speed = int(get_game_state(event_id, 'time_speed', 1))
-    
-    # ✅ Generowanie hasła na podstawie indeksów
-    password_value = get_game_state(event_id, 'game_password', 'SAPEREVENT')
-    revealed_indices_str = get_game_state(event_id, 'revealed_password_indices', '')
-    
-    # Parsuj indeksy
-    revealed_indices = set()
-    if revealed_indices_str:
-        try:
-            revealed_indices = set(map(int, revealed_indices_str.split(',')))
-        except (ValueError, AttributeError):
-            revealed_indices = set()
     
-    # Generuj displayed_password
-    displayed_password = ""
-    for i, char in enumerate(password_value):
-        if char == ' ':
-            displayed_password += '  '
-        elif i in revealed_indices:
-            displayed_password += char
-        else:
-            displayed_password += '_'
+    # ✅ Hasło z odkrytymi literami
+    displayed_password = get_displayed_password(event_id)
     
     return {
-        'game_active': is_active,
-        'is_timer_running': is_timer_running,
-        'time_left': time_left,
+        **timer,
         'password': displayed_password,
         'player_count': player_count,
         'correct_answers': correct_answers,
         'completion_percentage': completion_percentage,
         'game_status': game_status,
-        'time_elapsed': time_elapsed,
-        'time_elapsed_with_pauses': time_elapsed_with_pauses,
         'language_player': language_player,
         'language_host': language_host,
-        'bonus_multiplier': bonus_multiplier,
-        'time_speed': time_speed
+        'bonus_multiplier': bonus_multiplier
     }
 
+# --- Ranking graczy (w pamięci) ---
+# event_id -> {
+#   'players': {player_id: (name, score)},
+#   'order': posortowana lista (-score, player_id) - kolejność rankingu,
+#   'changed' / 'removed': gracze zmienieni od ostatniej emisji,
+#   'deltas': liczba delt od ostatniego snapshotu, 'snapshot_due': wymuszenie snapshotu
+# }
+_leaderboards = {}
+
+def _get_leaderboard(event_id):
+    event_id = _state_event_id(event_id)
+    board = _leaderboards.get(event_id)
+    if board is None:
+        rows = db.session.query(Player.id, Player.name, Player.score).filter_by(event_id=event_id).all()
+        players = {player_id: (name, score or 0) for player_id, name, score in rows}
+        board = {
+            'players': players,
+            'order': sorted((-score, player_id) for player_id, (name, score) in players.items()),
+            'changed': set(),
+            'removed': set(),
+            'deltas': 0,
+            'snapshot_due': True
+        }
+        _leaderboards[event_id] = board
+    return board
+
+def _leaderboard_unlink(board, player_id):
+    old = board['players'].pop(player_id, None)
+    if old is not None:
+        index = bisect.bisect_left(board['order'], (-old[1], player_id))
+        if index < len(board['order']) and board['order'][index] == (-old[1], player_id):
+            del board['order'][index]
+    return old
+
+def _set_leaderboard_entry(board, player_id, name, score):
+    """Ustawia wynik gracza w rankingu; zwraca True, jeśli coś się zmieniło"""
+    entry = (name, score or 0)
+    if board['players'].get(player_id) == entry:
+        return False
+    _leaderboard_unlink(board, player_id)
+    board['players'][player_id] = entry
+    bisect.insort(board['order'], (-entry[1], player_id))
+    return True
+
+def update_leaderboard_entry(player):
+    """Aktualizuje pozycję gracza w rankingu eventu (wywoływać po zapisie wyniku)"""
+    board = _get_leaderboard(player.event_id)
+    if _set_leaderboard_entry(board, player.id, player.name, player.score):
+        board['changed'].add(player.id)
+        board['removed'].discard(player.id)
+        publish_cluster_event('leaderboard', player.event_id,
+                              {'player_id': player.id, 'name': player.name, 'score': player.score or 0})
+
+def remove_leaderboard_entry(event_id, player_id):
+    board = _get_leaderboard(event_id)
+    if _leaderboard_unlink(board, player_id) is not None:
+        board['changed'].discard(player_id)
+        board['removed'].add(player_id)
+        publish_cluster_event('leaderboard_remove', event_id, {'player_id': player_id})
+
+def invalidate_leaderboard(event_id):
+    _leaderboards.pop(_state_event_id(event_id), None)
+    publish_cluster_event('leaderboard_reset', event_id)
+
+def leaderboard_snapshot(event_id):
+    """Pełny ranking eventu: lista {'id', 'name', 'score'} od najlepszego"""
+    board = _get_leaderboard(event_id)
+    players = board['players']
+    return [{'id': player_id, 'name': players[player_id][0], 'score': players[player_id][1]}
+            for _, player_id in board['order']]
+
 def event_to_dict(event):
     return {
         'id': event.id, 'name': event.name, 'login': event.login,
@@ -424,6 +897,489 @@ def delete_logo_file(event):
         except Exception as e:
             print(f"Błąd podczas usuwania pliku logo: {e}")
 
+# --- Kody QR (w pamięci) ---
+# event_id -> {code_identifier: {'id', 'color', 'claimed_by'}}
+_qr_code_cache = {}
+
+def _load_qr_codes(event_id):
+    rows = db.session.query(QRCode.code_identifier, QRCode.id, QRCode.color,
+                            QRCode.claimed_by_player_id).filter_by(event_id=event_id).all()
+    return {identifier: {'id': qr_id, 'color': color, 'claimed_by': claimed_by}
+            for identifier, qr_id, color, claimed_by in rows}
+
+def get_qr_code_entry(event_id, code_identifier):
+    """Rozwiązuje kod QR eventu bez zapytania do bazy (mapa ładowana raz na event)"""
+    event_id = _state_event_id(event_id)
+    codes = _qr_code_cache.get(event_id)
+    if codes is None:
+        codes = _qr_code_cache[event_id] = _load_qr_codes(event_id)
+    return codes.get(code_identifier)
+
+def warm_qr_codes(event_id):
+    """Ładuje mapę kodów od razu po wygenerowaniu, pozostałe procesy przeładują ją przy pierwszym skanie"""
+    event_id = _state_event_id(event_id)
+    _qr_code_cache[event_id] = _load_qr_codes(event_id)
+    publish_cluster_event('qr_reset', event_id)
+
+def invalidate_qr_codes(event_id):
+    _qr_code_cache.pop(_state_event_id(event_id), None)
+    publish_cluster_event('qr_reset', event_id)
+
+def claim_qr_code(entry, player_id):
+    """Atomowo zajmuje kod jednorazowy (w bieżącej transakcji) - False, jeśli ktoś był pierwszy"""
+    result = db.session.execute(
+        db.update(QRCode)
+        .where(QRCode.id == entry['id'], QRCode.claimed_by_player_id.is_(None))
+        .values(claimed_by_player_id=player_id)
+    )
+    return result.rowcount == 1
+
+def mark_qr_code_claimed(event_id, code_identifier, player_id):
+    """Zapisuje zajęcie kodu w mapie po commicie i powiadamia pozostałe procesy"""
+    codes = _qr_code_cache.get(_state_event_id(event_id))
+    if codes is not None and code_identifier in codes:
+        codes[code_identifier]['claimed_by'] = player_id
+    publish_cluster_event('qr_claim', event_id, {'code': code_identifier, 'player_id': player_id})
+
+# --- Punktacja graczy ---
+# Player.score zmienia się tylko atomowym UPDATE score = score + delta (z RETURNING nowego wyniku), więc
+# równoległe żądania tego samego gracza nie gubią punktów. Klient może wysłać nagłówek Idempotency-Key:
+# klucz jest rezerwowany w tej samej transakcji co punkty, a ponowione żądanie dostaje zapisaną odpowiedź.
+def _insert_on_conflict_do_nothing(table, values, index_elements):
+    """INSERT ... ON CONFLICT DO NOTHING na unikalnych kolumnach index_elements (SQLite/PostgreSQL)"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert(table).values(values).on_conflict_do_nothing(index_elements=index_elements)
+
+def idempotency_key():
+    """Klucz idempotencji żądania: nagłówek Idempotency-Key albo pole idempotency_key w JSON"""
+    key = request.headers.get('Idempotency-Key') or (request.get_json(silent=True) or {}).get('idempotency_key')
+    key = str(key or '').strip()[:64]
+    return key or None
+
+def replay_score_award(player_id, key):
+    """Zapisana odpowiedź wcześniejszego żądania z tym kluczem (nagłówek Idempotent-Replayed) albo None"""
+    if not key or not player_id:
+        return None
+    payload = db.session.query(ScoreAward.response).filter_by(player_id=player_id, idempotency_key=key).scalar()
+    if not payload:
+        return None
+    response = jsonify(json.loads(payload))
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def score_award_conflict(player_id, key):
+    """Odpowiedź na żądanie, którego klucz zajęło już inne (wycofuje bieżącą transakcję)"""
+    db.session.rollback()
+    return replay_score_award(player_id, key) or (jsonify({'error': 'To żądanie jest już przetwarzane'}), 409)
+
+def claim_score_award(player, key):
+    """Rezerwuje klucz idempotencji w bieżącej transakcji - False, jeśli inne żądanie już go użyło"""
+    if not key:
+        return True
+    values = {'player_id': player.id, 'event_id': player.event_id, 'idempotency_key': key,
+              'delta': 0, 'created_at': datetime.utcnow()}
+    stmt = _insert_on_conflict_do_nothing(ScoreAward.__table__, values, ['player_id', 'idempotency_key'])
+    if stmt is None:
+        if ScoreAward.query.filter_by(player_id=player.id, idempotency_key=key).first():
+            return False
+        stmt = db.insert(ScoreAward).values(values)
+    return db.session.execute(stmt).rowcount == 1
+
+def apply_score_delta(player, delta):
+    """Atomowo zmienia wynik gracza o delta (nie schodzi poniżej 0) i zwraca nowy wynik. Nie commituje."""
+    current = db.func.coalesce(Player.score, 0)
+    stmt = (db.update(Player).where(Player.id == player.id)
+            .values(score=db.case((current + delta < 0, 0), else_=current + delta))
+            .execution_options(synchronize_session=False))
+    if db.engine.dialect.update_returning:
+        score = db.session.execute(stmt.returning(Player.score)).scalar_one()
+    else:
+        db.session.execute(stmt)
+        score = db.session.query(Player.score).filter_by(id=player.id).scalar()
+    set_committed_value(player, 'score', score)
+    return score
+
+def store_score_response(player, key, delta, payload):
+    """Zapisuje przy kluczu idempotencji zmianę wyniku i odpowiedź (do powtórzenia przy ponowieniu)"""
+    if key:
+        db.session.execute(db.update(ScoreAward).where(
+            ScoreAward.player_id == player.id, ScoreAward.idempotency_key == key
+        ).values(delta=delta, score=player.score, response=json.dumps(payload)))
+    return payload
+
+# --- Talie pytań graczy ---
+def bump_question_set_version(event_id):
+    """Oznacza zmianę puli pytań eventu - talie graczy zostaną potasowane od nowa przy następnym losowaniu"""
+    version = int(get_game_state(event_id, 'question_set_version', '0'))
+    set_game_state(event_id, 'question_set_version', str(version + 1))
+
+def _shuffle_question_deck(deck, version):
+    answered = db.select(PlayerAnswer.question_id).where(PlayerAnswer.player_id == deck.player_id)
+    ids = [question_id for (question_id,) in db.session.query(Question.id).filter(
+        Question.event_id == deck.event_id,
+        Question.category == deck.category,
+        Question.id.notin_(answered)
+    )]
+    random.shuffle(ids)
+    deck.question_ids = ','.join(map(str, ids))
+    deck.position = 0
+    deck.version = version
+    return ids
+
+def _pop_from_deck(deck, ids, shuffled, shuffle, fetch):
+    """Zwraca pierwszy istniejący element talii (fetch(id) != None); wyczerpana talia jest tasowana raz"""
+    while True:
+        if deck.position >= len(ids):
+            if shuffled:
+                return None
+            ids = shuffle(deck)
+            shuffled = True
+            continue
+        item = fetch(ids[deck.position])
+        deck.position += 1
+        if item is not None:
+            return item
+
+def _get_or_create_deck(model, unique, **values):
+    """Talia gracza wg unikalnych kolumn `unique` - zwraca (deck, created).
+
+    Nowa talia (pusta) jest wstawiana przez INSERT ... ON CONFLICT DO NOTHING, więc dwa równoległe
+    pierwsze losowania tego samego gracza nie kończą się błędem unikalności - drugie czyta wiersz pierwszego.
+    """
+    filters = {key: values[key] for key in unique}
+    deck = model.query.filter_by(**filters).first()
+    if deck is not None:
+        return deck, False
+    stmt = _insert_on_conflict_do_nothing(model.__table__, values, list(unique))
+    if stmt is None:
+        stmt = db.insert(model).values(values)
+    created = db.session.execute(stmt).rowcount == 1
+    return model.query.filter_by(**filters).first(), created
+
+def _deck_ids(deck):
+    return [int(question_id) for question_id in deck.question_ids.split(',') if question_id]
+
+def draw_question(player_id, event_id, category):
+    """Zdejmuje kolejne pytanie z talii gracza (zapis w bieżącej transakcji).
+
+    Talia jest tasowana tylko po zmianie puli pytań albo gdy się wyczerpie - wtedy trafiają
+    do niej pytania, na które gracz nadal nie odpowiedział. None = brak pytań."""
+    version = int(get_game_state(event_id, 'question_set_version', '0'))
+    shuffle = lambda deck: _shuffle_question_deck(deck, version)
+    deck, created = _get_or_create_deck(QuestionDeck, ('player_id', 'category'),
+                                        player_id=player_id, event_id=event_id, category=category)
+    if created or deck.version != version:
+        ids, shuffled = shuffle(deck), True
+    else:
+        ids, shuffled = _deck_ids(deck), False
+
+    def fetch(question_id):
+        question = db.session.get(Question, question_id)
+        if question and question.event_id == event_id and question.category == category:
+            return question
+    return _pop_from_deck(deck, ids, shuffled, shuffle, fetch)
+
+def _shuffle_ai_question_deck(deck):
+    answered = db.select(AIPlayerAnswer.ai_question_id).where(
+        AIPlayerAnswer.player_id == deck.player_id, AIPlayerAnswer.event_id == deck.event_id
+    )
+    ids = [question_id for (question_id,) in db.session.query(AIQuestion.id).filter(
+        AIQuestion.category_id == deck.category_id,
+        AIQuestion.id.notin_(answered)
+    )]
+    random.shuffle(ids)
+    deck.question_ids = ','.join(map(str, ids))
+    deck.position = 0
+    return ids
+
+def draw_ai_question(player_id, event_id, category_id):
+    """Jak draw_question, dla pytań AI; talie kategorii są kasowane przy zmianie jej pytań"""
+    deck, created = _get_or_create_deck(AIQuestionDeck, ('player_id', 'category_id'),
+                                        player_id=player_id, event_id=event_id, category_id=category_id)
+    if created:
+        ids, shuffled = _shuffle_ai_question_deck(deck), True
+    else:
+        ids, shuffled = _deck_ids(deck), False
+
+    def fetch(question_id):
+        question = db.session.get(AIQuestion, question_id)
+        if question and question.category_id == category_id:
+            return question
+    return _pop_from_deck(deck, ids, shuffled, _shuffle_ai_question_deck, fetch)
+
+def invalidate_ai_question_decks(category_ids):
+    """Kasuje talie graczy dla kategorii, których pytania się zmieniły (w bieżącej transakcji)"""
+    if category_ids:
+        AIQuestionDeck.query.filter(AIQuestionDeck.category_id.in_(list(category_ids))).delete(synchronize_session=False)
+
+# --- Katalog kategorii AI Quiz (w pamięci) ---
+# {'categories': [dict], 'counts': {category_id: liczba pytań}, 'views': {klucz: (payload, etag)},
+#  'signature': liczba i max id pytań/kategorii w bazie, 'checked_at': czas ostatniego sprawdzenia}
+# Zmiany z innego procesu bez Redis (np. flask load-ai-questions) wykrywa porównanie sygnatury
+# z bazą co AI_CATALOG_CHECK_SECONDS.
+AI_CATALOG_CHECK_SECONDS = int(os.environ.get('AI_CATALOG_CHECK_SECONDS', 10))
+_ai_catalog = None
+
+def _ai_category_dict(category):
+    return {
+        'id': category.id,
+        'name': category.name,
+        'difficulty': category.difficulty,
+        'is_active': category.is_active,
+        'is_default': category.is_default,
+        'is_custom': category.is_custom,
+        'created_by_api': category.created_by_api,
+        'event_id': category.event_id
+    }
+
+def _ai_catalog_signature():
+    questions = db.session.query(db.func.count(AIQuestion.id), db.func.max(AIQuestion.id)).one()
+    categories = db.session.query(db.func.count(AIQuizCategory.id), db.func.max(AIQuizCategory.id)).one()
+    return tuple(questions) + tuple(categories)
+
+def _get_ai_catalog():
+    global _ai_catalog
+    now = datetime.utcnow()
+    if _ai_catalog is not None and now - _ai_catalog['checked_at'] >= timedelta(seconds=AI_CATALOG_CHECK_SECONDS):
+        _ai_catalog['checked_at'] = now
+        if _ai_catalog_signature() != _ai_catalog['signature']:
+            _ai_catalog = None
+    if _ai_catalog is None:
+        signature = _ai_catalog_signature()
+        counts = db.session.query(AIQuestion.category_id, db.func.count(AIQuestion.id)).group_by(AIQuestion.category_id).all()
+        _ai_catalog = {
+            'categories': [_ai_category_dict(c) for c in AIQuizCategory.query.order_by(AIQuizCategory.id)],
+            'counts': dict(counts),
+            'views': {},
+            'signature': signature,
+            'checked_at': now
+        }
+    return _ai_catalog
+
+def invalidate_ai_catalog():
+    """Wywoływać po każdej zmianie kategorii AI (po commicie)"""
+    global _ai_catalog
+    _ai_catalog = None
+    publish_cluster_event('ai_catalog', None)
+
+def add_ai_question_count(category_id, delta):
+    """Aktualizuje licznik pytań kategorii w katalogu bez przeładowania (po commicie)"""
+    if _ai_catalog is not None:
+        counts = _ai_catalog['counts']
+        counts[category_id] = counts.get(category_id, 0) + delta
+        _ai_catalog['views'].clear()
+    publish_cluster_event('ai_catalog', None)
+
+def ai_catalog_view(key, build):
+    """Zwraca (payload, etag) widoku katalogu - build(catalog) wywoływane raz na wersję katalogu"""
+    catalog = _get_ai_catalog()
+    view = catalog['views'].get(key)
+    if view is None:
+        payload = build(catalog)
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+        view = catalog['views'][key] = (payload, etag)
+    return view
+
+def _event_ai_categories(catalog, event_id):
+    """Domyślne kategorie (wspólne dla eventów) i custom kategorie eventu"""
+    default_categories = [c for c in catalog['categories'] if c['is_default'] and c['event_id'] is None]
+    custom_categories = [c for c in catalog['categories'] if c['is_custom'] and c['event_id'] == event_id]
+    return default_categories, custom_categories
+
+# --- Import pytań AI (seed i paczki JSON/CSV) ---
+AI_IMPORT_BATCH = 1000
+
+def _ai_question_source_key(question_text):
+    """Klucz importu: hash znormalizowanej treści pytania (w obrębie kategorii).
+
+    Zapisywany w AIQuestion.source_key przy imporcie i nie zmienia się przy edycji pytania,
+    więc ponowny import nie dodaje drugi raz pytania, które admin poprawił.
+    """
+    return hashlib.sha1(_normalize_text(question_text).encode('utf-8')).hexdigest()
+
+def _pack_record(category_name, item):
+    """Ujednolica rekord (format seed: q/a/b/c/correct albo nazwy kolumn modelu)"""
+    def field(*keys):
+        for key in keys:
+            if item.get(key):
+                return str(item[key]).strip()
+        return ''
+    return {
+        'category': (category_name or field('category')).strip(),
+        'question_text': field('q', 'question_text'),
+        'option_a': field('a', 'option_a'),
+        'option_b': field('b', 'option_b'),
+        'option_c': field('c', 'option_c'),
+        'correct_answer': field('correct', 'correct_answer').upper(),
+        'difficulty': field('difficulty') or 'medium'
+    }
+
+def iter_seed_records():
+    from ai_questions_seed import AI_QUESTIONS_SEED
+    for category_name, questions in AI_QUESTIONS_SEED.items():
+        for item in questions:
+            yield _pack_record(category_name, item)
+
+def _iter_json_pack(f, chunk_size=1 << 16):
+    """Strumieniowo czyta paczkę .json - listę pytań albo {kategoria: [pytania]} (jak seed).
+
+    Zwraca kolejne (nazwa kategorii albo None, pytanie); w pamięci jest tylko bieżący fragment pliku.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos = '', 0
+
+    def read_more():
+        nonlocal buffer, pos
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise ValueError('Niekompletny lub nieprawidłowy plik JSON')
+        buffer, pos = buffer[pos:] + chunk, 0
+
+    def peek():
+        # Następny znak poza białymi znakami i przecinkami między elementami
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            read_more()
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f'Nieprawidłowy plik JSON: oczekiwano {char!r}')
+        pos += 1
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+                return obj
+            except json.JSONDecodeError:
+                read_more()  # wartość jeszcze niekompletna
+
+    def items(category_name):
+        nonlocal pos
+        expect('[')
+        while peek() != ']':
+            yield category_name, value()
+        pos += 1
+
+    if peek() == '[':
+        yield from items(None)
+        return
+    expect('{')
+    while peek() != '}':
+        category_name = value()
+        expect(':')
+        yield from items(category_name)
+
+def iter_pack_records(path):
+    """Czyta paczkę z dysku strumieniowo: .csv, .jsonl i .json (słownik kategorii jak seed lub lista)"""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if extension == '.csv':
+            for row in csv.DictReader(f):
+                yield _pack_record(None, row)
+        elif extension in ('.jsonl', '.ndjson'):
+            for line in f:
+                if line.strip():
+                    yield _pack_record(None, json.loads(line))
+        else:
+            for category_name, item in _iter_json_pack(f):
+                yield _pack_record(category_name, item)
+
+def bulk_load_ai_questions(records, create_categories=False):
+    """
+    Ładuje pytania do domyślnych kategorii - jeden INSERT (executemany) na kategorię i partię.
+    Pytania już obecne w kategorii (ten sam source_key) są pomijane. Kategorie spoza bazy
+    są tworzone tylko z create_categories=True.
+    """
+    stats = {'loaded': 0, 'duplicates': 0, 'invalid': 0, 'unknown_category': 0, 'categories_created': 0}
+    categories = {}  # nazwa -> (category_id, klucze importu pytań w kategorii)
+    pending = defaultdict(list)
+    loaded = defaultdict(int)
+
+    def category_for(name):
+        if name not in categories:
+            category = AIQuizCategory.query.filter_by(name=name, is_default=True).first()
+            if category is None and create_categories:
+                category = AIQuizCategory(name=name, difficulty='medium', is_active=True, is_default=True,
+                                          is_custom=False, event_id=None, created_by_api=False)
+                db.session.add(category)
+                db.session.flush()
+                stats['categories_created'] += 1
+            keys, backfill = set(), []
+            if category is not None:
+                for question_id, question_text, source_key in db.session.query(
+                        AIQuestion.id, AIQuestion.question_text, AIQuestion.source_key).filter_by(category_id=category.id):
+                    if source_key is None:
+                        # Pytania sprzed source_key (i dodane poza importem) - klucz z obecnej treści
+                        source_key = _ai_question_source_key(question_text)
+                        backfill.append({'question_id': question_id, 'key': source_key})
+                    keys.add(source_key)
+            if backfill:
+                db.session.execute(
+                    AIQuestion.__table__.update().where(AIQuestion.id == db.bindparam('question_id'))
+                    .values(source_key=db.bindparam('key')),
+                    backfill
+                )
+            categories[name] = (category.id if category else None, keys)
+        return categories[name]
+
+    def flush(category_id):
+        rows = pending.pop(category_id, [])
+        if rows:
+            db.session.execute(db.insert(AIQuestion), rows)
+            loaded[category_id] += len(rows)
+
+    for record in records:
+        if not (record['category'] and record['question_text'] and record['option_a'] and record['option_b']
+                and record['option_c'] and record['correct_answer'] in ('A', 'B', 'C')):
+            stats['invalid'] += 1
+            continue
+        category_id, keys = category_for(record['category'])
+        if category_id is None:
+            stats['unknown_category'] += 1
+            continue
+        source_key = _ai_question_source_key(record['question_text'])
+        if source_key in keys:
+            stats['duplicates'] += 1
+            continue
+        keys.add(source_key)
+        pending[category_id].append({
+            'category_id': category_id,
+            'source_key': source_key,
+            'question_text': record['question_text'][:500],
+            'option_a': record['option_a'][:200],
+            'option_b': record['option_b'][:200],
+            'option_c': record['option_c'][:200],
+            'correct_answer': record['correct_answer'],
+            'difficulty': record['difficulty'] if record['difficulty'] in ('easy', 'medium', 'advanced') else 'medium'
+        })
+        if len(pending[category_id]) >= AI_IMPORT_BATCH:
+            flush(category_id)
+    for category_id in list(pending):
+        flush(category_id)
+
+    invalidate_ai_question_decks(loaded)
+    db.session.commit()
+    if stats['categories_created']:
+        invalidate_ai_catalog()
+    else:
+        for category_id, count in loaded.items():
+            add_ai_question_count(category_id, count)
+    stats['loaded'] = sum(loaded.values())
+    return stats
+
 # --- Główne Ścieżki ---
 @app.route('/')
 def index(): 
@@ -576,6 +1532,12 @@ def update_or_delete_event(event_id):
         delete_logo_file(event)
         db.session.delete(event)
         db.session.commit()
+        invalidate_ai_catalog()
+        invalidate_game_state(event_id)
+        invalidate_leaderboard(event_id)
+        invalidate_qr_codes(event_id)
+        invalidate_photo_feed(event_id)
+        schedule_game_deadline(event_id)
         return jsonify({'message': f'Event {event_id} został pomyślnie usunięty.'})
 
 @app.route('/api/admin/event/<int:event_id>/upload_logo', methods=['POST'])
@@ -617,10 +1579,19 @@ def reset_event(event_id):
         QRCode.query.filter_by(event_id=event_id).delete()
         PlayerScan.query.filter_by(event_id=event_id).delete()
         PlayerAnswer.query.filter_by(event_id=event_id).delete()
+        QuestionDeck.query.filter_by(event_id=event_id).delete()
+        AIQuestionDeck.query.filter_by(event_id=event_id).delete()
+        FunnyPhotoVariant.query.filter_by(event_id=event_id).delete()
         FunnyPhoto.query.filter_by(event_id=event_id).delete()
         PhotoVote.query.filter_by(event_id=event_id).delete()
+        ScoreAward.query.filter_by(event_id=event_id).delete()
         GameState.query.filter_by(event_id=event_id).delete()
         db.session.commit()
+        invalidate_game_state(event_id)
+        invalidate_leaderboard(event_id)
+        invalidate_qr_codes(event_id)
+        invalidate_photo_feed(event_id)
+        schedule_game_deadline(event_id)
         room = f'event_{event_id}'
         emit_leaderboard_update(room)
         emit_password_update(room)
@@ -634,39 +1605,9 @@ def reset_event(event_id):
 @app.route('/api/admin/ai-quiz/load-questions', methods=['POST'])
 @admin_required
 def load_ai_questions():
-    """Załaduj pytania z seed do bazy (tylko dla admina)"""
+    """Załaduj pytania z seed do bazy (tylko dla admina) - brakujące pytania, bez duplikatów"""
     try:
-        from ai_questions_seed import AI_QUESTIONS_SEED
-
-        loaded_count = 0
-        for category_name, questions in AI_QUESTIONS_SEED.items():
-            # Znajdź kategorię
-            category = AIQuizCategory.query.filter_by(name=category_name, is_default=True).first()
-            if not category:
-                continue
-
-            # Sprawdź ile pytań już jest dla tej kategorii
-            existing_count = AIQuestion.query.filter_by(category_id=category.id).count()
-
-            if existing_count > 0:
-                # Pytania już są - pomiń
-                continue
-
-            # Dodaj pytania
-            for q_data in questions:
-                question = AIQuestion(
-                    category_id=category.id,
-                    question_text=q_data['q'],
-                    option_a=q_data['a'],
-                    option_b=q_data['b'],
-                    option_c=q_data['c'],
-                    correct_answer=q_data['correct'],
-                    difficulty=q_data['difficulty']
-                )
-                db.session.add(question)
-                loaded_count += 1
-
-        db.session.commit()
+        loaded_count = bulk_load_ai_questions(iter_seed_records())['loaded']
         return jsonify({
             'message': f'Załadowano {loaded_count} pytań do bazy',
             'loaded_count': loaded_count
@@ -679,12 +1620,12 @@ def load_ai_questions():
 @admin_required
 def get_ai_categories_admin():
     """Pobierz wszystkie kategorie AI Quiz (dla admina)"""
-    categories = AIQuizCategory.query.filter_by(is_default=True).all()
-    return jsonify([{
-        'id': cat.id,
-        'name': cat.name,
-        'question_count': AIQuestion.query.filter_by(category_id=cat.id).count()
-    } for cat in categories])
+    payload, _ = ai_catalog_view('admin', lambda catalog: [{
+        'id': cat['id'],
+        'name': cat['name'],
+        'question_count': catalog['counts'].get(cat['id'], 0)
+    } for cat in catalog['categories'] if cat['is_default']])
+    return jsonify(payload)
 
 @app.route('/api/admin/ai-quiz/questions/<int:category_id>', methods=['GET'])
 @admin_required
@@ -719,6 +1660,7 @@ def update_ai_question(question_id):
     question.correct_answer = data.get('correct_answer', question.correct_answer)
     question.difficulty = data.get('difficulty', question.difficulty)
 
+    invalidate_ai_question_decks([question.category_id])
     db.session.commit()
     return jsonify({'message': 'Pytanie zaktualizowane'})
 
@@ -738,6 +1680,7 @@ def admin_generate_qr_codes():
         for i in range(1, int(counts.get(color, 0)) + 1):
             db.session.add(QRCode(code_identifier=f"{prefix}{i}", color=color, event_id=event_id))
     db.session.commit()
+    warm_qr_codes(event_id)
     return jsonify({'message': 'Kody QR zostały wygenerowane.'})
 
 @app.route('/api/host/qrcodes', methods=['GET'])
@@ -765,35 +1708,28 @@ def get_host_ai_categories():
     """Zwraca wszystkie kategorie AI (10 domyślnych + custom dla tego eventu)"""
     event_id = session['host_event_id']
 
-    # Pobierz 10 domyślnych kategorii
-    default_categories = AIQuizCategory.query.filter_by(
-        is_default=True,
-        event_id=None
-    ).all()
-
-    # Pobierz custom kategorie dla tego eventu
-    custom_categories = AIQuizCategory.query.filter_by(
-        is_custom=True,
-        event_id=event_id
-    ).all()
+    def build(catalog):
+        default_categories, custom_categories = _event_ai_categories(catalog, event_id)
+
+        def category_to_dict(cat):
+            return {
+                'id': cat['id'],
+                'name': cat['name'],
+                'difficulty': cat['difficulty'],
+                'is_active': cat['is_active'],
+                'is_default': cat['is_default'],
+                'is_custom': cat['is_custom'],
+                'created_by_api': cat['created_by_api'],
+                'question_count': catalog['counts'].get(cat['id'], 0)
+            }
 
-    def category_to_dict(cat):
-        question_count = AIQuestion.query.filter_by(category_id=cat.id).count()
         return {
-            'id': cat.id,
-            'name': cat.name,
-            'difficulty': cat.difficulty,
-            'is_active': cat.is_active,
-            'is_default': cat.is_default,
-            'is_custom': cat.is_custom,
-            'created_by_api': cat.created_by_api,
-            'question_count': question_count
+            'default_categories': [category_to_dict(c) for c in default_categories],
+            'custom_categories': [category_to_dict(c) for c in custom_categories]
         }
 
-    return jsonify({
-        'default_categories': [category_to_dict(c) for c in default_categories],
-        'custom_categories': [category_to_dict(c) for c in custom_categories]
-    })
+    payload, _ = ai_catalog_view(('host', event_id), build)
+    return jsonify(payload)
 
 @app.route('/api/host/ai-quiz/category/<int:category_id>/toggle', methods=['POST'])
 @host_required
@@ -812,6 +1748,7 @@ def toggle_ai_category(category_id):
 
     category.is_active = not category.is_active
     db.session.commit()
+    invalidate_ai_catalog()
 
     return jsonify({
         'message': 'Status kategorii zmieniony',
@@ -839,41 +1776,39 @@ def update_category_difficulty(category_id):
 
     category.difficulty = new_difficulty
     db.session.commit()
+    invalidate_ai_catalog()
 
     return jsonify({
         'message': 'Poziom trudności zmieniony',
         'difficulty': new_difficulty
     })
 
-def generate_questions_with_claude(category_name, difficulty, num_questions=10):
-    """
-    Generuje pytania quizowe przez Claude API
-    """
-    import json
-    
-    api_key = os.environ.get('ANTHROPIC_API_KEY')
-    if not api_key:
-        raise Exception('ANTHROPIC_API_KEY nie jest ustawiony w zmiennych środowiskowych')
-
-    # Usuń zmienne proxy
-    old_proxies = {}
-    for key in ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy']:
-        if key in os.environ:
-            old_proxies[key] = os.environ.pop(key)
-
-    try:
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        difficulty_map = {
-            'easy': 'łatwy (podstawowy)',
-            'medium': 'średni (wymaga wiedzy ogólnej)',
-            'advanced': 'zaawansowany (wymaga specjalistycznej wiedzy)'
-        }
+# --- Generowanie pytań AI w tle ---
+AI_GENERATION_WORKERS = int(os.environ.get('AI_GENERATION_WORKERS', 2))
+AI_QUESTIONS_PER_CATEGORY = 10
+AI_POOL_EXTRA_QUESTIONS = 3  # zapas na duplikaty odrzucone podczas generowania
+AI_DUPLICATE_MAX_BITS = 12  # maks. odległość Hamminga simhashy dla "prawie tych samych" pytań
+CLAUDE_MODEL = os.environ.get('CLAUDE_MODEL', 'claude-3-5-sonnet-20241022')
+AI_JOB_LEASE_SECONDS = int(os.environ.get('AI_JOB_LEASE_SECONDS', 60))
+_generation_queue = queue.Queue()
+_queued_generation_jobs = set()  # id zadań czekających w lokalnej kolejce (bez podwójnego wrzucania)
+
+def enqueue_generation_job(job_id):
+    if job_id not in _queued_generation_jobs:
+        _queued_generation_jobs.add(job_id)
+        _generation_queue.put(job_id)
+
+def _claude_prompt(category_name, difficulty, num_questions):
+    difficulty_map = {
+        'easy': 'łatwy (podstawowy)',
+        'medium': 'średni (wymaga wiedzy ogólnej)',
+        'advanced': 'zaawansowany (wymaga specjalistycznej wiedzy)'
+    }
 
-        difficulty_desc = difficulty_map.get(difficulty, 'średni')
-        
-        # ✅ KLUCZOWA ZMIANA: Użyj prostych znaków ASCII w promptcie
-        prompt = f"""Generate {num_questions} quiz questions about: {category_name}
+    difficulty_desc = difficulty_map.get(difficulty, 'średni')
+    
+    # ✅ KLUCZOWA ZMIANA: Użyj prostych znaków ASCII w promptcie
+    prompt = f"""Generate {num_questions} quiz questions about: {category_name}
 
 Requirements:
 - Difficulty level: {difficulty_desc}
@@ -897,49 +1832,299 @@ Response format (JSON):
 
 IMPORTANT: Return ONLY valid JSON (no markdown, no ```json, no additional text).
 All question and answer texts must be in POLISH language."""
+    return prompt
 
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
+def _claude_client():
+    api_key = os.environ.get('ANTHROPIC_API_KEY')
+    if not api_key:
+        raise Exception('ANTHROPIC_API_KEY nie jest ustawiony w zmiennych środowiskowych')
+
+    # Usuń zmienne proxy (httpx czyta je przy tworzeniu klienta)
+    old_proxies = {}
+    for key in ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy']:
+        if key in os.environ:
+            old_proxies[key] = os.environ.pop(key)
+    try:
+        # Import przy pierwszym użyciu - SDK ładuje się ~1 s, a nie jest potrzebne do startu serwera.
+        # ANTHROPIC_BASE_URL (czytany przez SDK) pozwala wskazać lokalny serwer testowy
+        import anthropic
+        return anthropic.Anthropic(api_key=api_key)
+    finally:
+        # Przywróć zmienne proxy
+        for key, value in old_proxies.items():
+            os.environ[key] = value
+
+def _iter_json_objects(chunks):
+    """Wyciąga kolejne obiekty {...} z tablicy JSON przychodzącej we fragmentach"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            start = buffer.find('{')
+            if start == -1:
+                break
+            try:
+                obj, end = decoder.raw_decode(buffer, start)
+            except json.JSONDecodeError:
+                break  # obiekt jeszcze niekompletny - czekaj na kolejny fragment
+            buffer = buffer[end:]
+            yield obj
+
+def stream_questions_with_claude(category_name, difficulty, num_questions=10):
+    """
+    Generuje pytania quizowe przez Claude API (streaming) - zwraca kolejne pytania,
+    gdy tylko się sparsują; pytania w złym formacie są pomijane
+    """
+    import anthropic
+    client = _claude_client()
+    try:
+        with client.messages.stream(
+            model=CLAUDE_MODEL,
             max_tokens=4000,
-            messages=[{"role": "user", "content": prompt}]
-        )
+            messages=[{"role": "user", "content": _claude_prompt(category_name, difficulty, num_questions)}]
+        ) as stream:
+            for q in _iter_json_objects(stream.text_stream):
+                if not all(key in q for key in ['q', 'a', 'b', 'c', 'correct']) or q['correct'] not in ['A', 'B', 'C']:
+                    print(f"⚠️ Pominięto pytanie w nieprawidłowym formacie: {q}")
+                    continue
+                yield q
+    except anthropic.APIError as e:
+        raise Exception(f'Błąd API Claude: {str(e)}')
 
-        response_text = message.content[0].text.strip()
+# --- Pula pytań AI ---
+def _normalize_text(text):
+    """Małe litery, bez polskich znaków i interpunkcji, pojedyncze spacje"""
+    text = unicodedata.normalize('NFKD', (text or '').lower().replace('ł', 'l'))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+def pool_topic_key(category_name, difficulty):
+    return f"{_normalize_text(category_name)[:130]}|{difficulty}"
+
+def question_fingerprint(question_text, shingle=4):
+    """64-bitowy simhash z 4-znakowych shingli znormalizowanej treści (jako BIGINT ze znakiem)"""
+    text = _normalize_text(question_text)
+    weights = [0] * 64
+    for piece in {text[i:i + shingle] for i in range(max(1, len(text) - shingle + 1))}:
+        h = int.from_bytes(hashlib.blake2b(piece.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    value = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _answer_key(q_data):
+    return _normalize_text(q_data[q_data['correct'].lower()])[:200]
+
+def is_near_duplicate(fingerprint, answer_key, known):
+    """Prawie identyczna treść i ta sama poprawna odpowiedź (samo podobieństwo treści myli np. "symbol Fe" i "symbol Au")"""
+    for other_fingerprint, other_answer in known:
+        if answer_key == other_answer and bin((fingerprint ^ other_fingerprint) & (2 ** 64 - 1)).count('1') <= AI_DUPLICATE_MAX_BITS:
+            return True
+    return False
+
+def take_from_pool(category, count):
+    """Dodaje do kategorii do `count` pytań z puli (najrzadziej używane) - zwraca liczbę pytań"""
+    pooled = AIQuestionPool.query.filter_by(topic_key=pool_topic_key(category.name, category.difficulty)) \
+        .order_by(AIQuestionPool.times_used, db.func.random()).limit(count).all()
+    for item in pooled:
+        item.times_used += 1
+        db.session.add(AIQuestion(
+            category_id=category.id,
+            question_text=item.question_text,
+            option_a=item.option_a,
+            option_b=item.option_b,
+            option_c=item.option_c,
+            correct_answer=item.correct_answer,
+            difficulty=category.difficulty
+        ))
+    return len(pooled)
 
-        # Usuń markdown wrapper
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]
-        if response_text.startswith('```'):
-            response_text = response_text[3:]
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]
-        response_text = response_text.strip()
+def generation_job_to_dict(job, category_name=None):
+    return {
+        'job_id': job.id,
+        'category_id': job.category_id,
+        'category_name': category_name,
+        'status': job.status,
+        'requested': job.requested,
+        'generated': job.generated,
+        'error': job.error
+    }
 
-        # Parse JSON
-        questions = json.loads(response_text)
+def _emit_generation_progress(job, category_name):
+    socketio.emit('ai_generation_progress', generation_job_to_dict(job, category_name), room=f'host_{job.event_id}')
 
-        # Walidacja
-        if not isinstance(questions, list):
-            raise Exception('Odpowiedź API nie jest listą pytań')
+def submit_generation_job(category, num_questions=AI_QUESTIONS_PER_CATEGORY):
+    """Zapisuje zadanie i wrzuca je do kolejki workerów - zwraca od razu"""
+    job = AIGenerationJob(event_id=category.event_id, category_id=category.id, requested=num_questions)
+    db.session.add(job)
+    db.session.commit()
+    enqueue_generation_job(job.id)
+    return job
 
-        for q in questions:
-            if not all(key in q for key in ['q', 'a', 'b', 'c', 'correct']):
-                raise Exception('Pytanie ma nieprawidłowy format')
-            if q['correct'] not in ['A', 'B', 'C']:
-                raise Exception('Nieprawidłowa poprawna odpowiedź')
+def _generation_job_heartbeat(job_id, node_id, lease):
+    """Greenlet obok zadania: przedłuża lease_until; gdy zadanie przejął inny proces, ustawia lease['lost']"""
+    while True:
+        socketio.sleep(AI_JOB_LEASE_SECONDS / 3)
+        with app.app_context():
+            try:
+                renewed = db.session.execute(
+                    db.update(AIGenerationJob)
+                    .where(AIGenerationJob.id == job_id, AIGenerationJob.owner == node_id,
+                           AIGenerationJob.status == 'running')
+                    .values(lease_until=datetime.utcnow() + timedelta(seconds=AI_JOB_LEASE_SECONDS))
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+                db.session.commit()
+                if not renewed:
+                    lease['lost'] = True
+                    return
+            except Exception as e:
+                print(f"❌ Nie udało się przedłużyć zadania {job_id}: {e}")
+            finally:
+                db.session.remove()
+
+def run_generation_job(job_id):
+    """Generuje pytania zadania; każde pytanie jest zapisywane w osobnej, krótkiej transakcji"""
+    job = db.session.get(AIGenerationJob, job_id)
+    if not job or job.status != 'queued':
+        return
+    category = db.session.get(AIQuizCategory, job.category_id)
+    if not category:
+        job.status, job.error, job.finished_at = 'failed', 'Kategoria nie istnieje', datetime.utcnow()
+        db.session.commit()
+        return
+    category_id, category_name, difficulty = category.id, category.name, category.difficulty
+
+    # Atomowe przejęcie - to samo zadanie mogą mieć w kolejce dwa procesy (wznowienie po restarcie)
+    node_id = _cluster_node_id()
+    claimed = db.session.execute(
+        db.update(AIGenerationJob)
+        .where(AIGenerationJob.id == job_id, AIGenerationJob.status == 'queued')
+        .values(status='running', owner=node_id,
+                lease_until=datetime.utcnow() + timedelta(seconds=AI_JOB_LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+    lease = {'lost': False}
+    heartbeat = gevent.spawn(_generation_job_heartbeat, job_id, node_id, lease)
+    try:
+        _generate_job_questions(job_id, category_id, category_name, difficulty, lease)
+    finally:
+        heartbeat.kill()
 
-        return questions
+def _generate_job_questions(job_id, category_id, category_name, difficulty, lease):
+    job = db.session.get(AIGenerationJob, job_id)
+    _emit_generation_progress(job, category_name)
+    print(f"🤖 Generating AI questions for category: {category_name} (job {job_id})")
 
-    except anthropic.APIError as e:
-        raise Exception(f'Błąd API Claude: {str(e)}')
-    except json.JSONDecodeError as e:
-        raise Exception(f'Błąd parsowania odpowiedzi API: {str(e)}')
+    topic_key = pool_topic_key(category_name, difficulty)
+    known = db.session.query(AIQuestionPool.fingerprint, AIQuestionPool.answer_key).filter_by(topic_key=topic_key).all()
+    duplicates = 0
+    try:
+        for q_data in stream_questions_with_claude(category_name, difficulty, job.requested - job.generated + AI_POOL_EXTRA_QUESTIONS):
+            fingerprint, answer_key = question_fingerprint(q_data['q']), _answer_key(q_data)
+            if is_near_duplicate(fingerprint, answer_key, known):
+                print(f"♻️ Pominięto duplikat pytania: {q_data['q']}")
+                duplicates += 1
+                continue
+            known.append((fingerprint, answer_key))
+            db.session.add(AIQuestionPool(
+                topic_key=topic_key,
+                question_text=q_data['q'],
+                option_a=q_data['a'],
+                option_b=q_data['b'],
+                option_c=q_data['c'],
+                correct_answer=q_data['correct'],
+                fingerprint=fingerprint,
+                answer_key=answer_key,
+                times_used=1
+            ))
+            db.session.add(AIQuestion(
+                category_id=category_id,
+                question_text=q_data['q'],
+                option_a=q_data['a'],
+                option_b=q_data['b'],
+                option_c=q_data['c'],
+                correct_answer=q_data['correct'],
+                difficulty=difficulty
+            ))
+            if lease['lost']:
+                # Lease wygasł i zadanie przejął inny proces - on dokończy generowanie
+                db.session.rollback()
+                print(f"⚠️  Job {job_id} taken over by another process, stopping")
+                return
+            job.generated += 1
+            db.session.commit()
+            add_ai_question_count(category_id, 1)
+            _emit_generation_progress(job, category_name)
+            if job.generated >= job.requested:
+                break
+        if job.generated:
+            job.status = 'done'
+        elif duplicates:
+            job.status, job.error = 'failed', 'Wszystkie wygenerowane pytania były duplikatami pytań z puli'
+        else:
+            job.status, job.error = 'failed', 'API nie zwróciło żadnego poprawnego pytania'
     except Exception as e:
-        raise Exception(f'Nieoczekiwany błąd: {str(e)}')
-    finally:
-        # Przywróć zmienne proxy
-        for key, value in old_proxies.items():
-            os.environ[key] = value
+        db.session.rollback()
+        job = db.session.get(AIGenerationJob, job_id)
+        job.status, job.error = 'failed', str(e)[:500]
+        print(f"❌ Error generating questions (job {job_id}): {e}")
+
+    job.finished_at = datetime.utcnow()
+    job.lease_until = None
+    invalidate_ai_question_decks([category_id])
+    db.session.commit()
+    _emit_generation_progress(job, category_name)
+    print(f"✅ Job {job_id}: {job.status}, {job.generated}/{job.requested} questions")
+
+def resume_generation_jobs(expired_only=False):
+    """Wrzuca z powrotem do kolejki zadania przerwane restartem procesu - zwraca ich liczbę.
+
+    Bez kolejki wiadomości (jeden proces) przy starcie wznawia wszystkie queued/running.
+    W klastrze wywołuje go lider z expired_only=True: zadania 'running' tylko po wygaśnięciu
+    lease_until (inaczej wciąż wykonuje je żywy proces), a 'queued' starsze niż lease.
+    Zadanie 'running' wraca do 'queued' i dogenerowuje brakujące pytania (generated zostaje).
+    """
+    now = datetime.utcnow()
+    running = AIGenerationJob.status == 'running'
+    queued = AIGenerationJob.status == 'queued'
+    if expired_only:
+        running = db.and_(running, db.or_(AIGenerationJob.lease_until.is_(None), AIGenerationJob.lease_until < now))
+        queued = db.and_(queued, AIGenerationJob.created_at < now - timedelta(seconds=AI_JOB_LEASE_SECONDS))
+    job_ids = [job_id for (job_id,) in db.session.query(AIGenerationJob.id)
+               .filter(db.or_(running, queued)).order_by(AIGenerationJob.id)
+               if job_id not in _queued_generation_jobs]
+    if not job_ids:
+        return 0
+    # Warunek powtórzony w UPDATE - zadanie, którego lease właśnie przedłużono, zostaje u właściciela
+    db.session.execute(
+        db.update(AIGenerationJob).where(AIGenerationJob.id.in_(job_ids), running)
+        .values(status='queued', owner=None, lease_until=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    for job_id in job_ids:
+        enqueue_generation_job(job_id)
+    if job_ids:
+        print(f"🔁 Resumed {len(job_ids)} AI generation job(s)")
+    return len(job_ids)
+
+def generation_worker():
+    """Worker puli generowania - wykonuje zadania z kolejki po jednym"""
+    while True:
+        job_id = _generation_queue.get()
+        _queued_generation_jobs.discard(job_id)
+        with app.app_context():
+            try:
+                run_generation_job(job_id)
+            except Exception as e:
+                print(f"❌ Generation worker error (job {job_id}): {e}")
+            finally:
+                db.session.remove()
 
 
 @app.route('/api/host/ai-quiz/category', methods=['POST'])
@@ -960,6 +2145,10 @@ def add_custom_category():
         if difficulty not in ['easy', 'medium', 'advanced']:
             return jsonify({'error': 'Nieprawidłowy poziom trudności'}), 400
 
+        if use_claude_api and not os.environ.get('ANTHROPIC_API_KEY') and AIQuestionPool.query.filter_by(
+                topic_key=pool_topic_key(category_name, difficulty)).count() < AI_QUESTIONS_PER_CATEGORY:
+            return jsonify({'error': 'Błąd podczas generowania pytań: ANTHROPIC_API_KEY nie jest ustawiony w zmiennych środowiskowych'}), 500
+
         # Sprawdź czy kategoria już istnieje dla tego eventu
         existing = AIQuizCategory.query.filter_by(
             name=category_name,
@@ -983,55 +2172,29 @@ def add_custom_category():
         db.session.add(new_category)
         db.session.flush()
 
-        # Jeśli użytkownik wybrał generowanie przez Claude API
+        # Jeśli użytkownik wybrał generowanie przez Claude API - najpierw pytania z puli, brakujące powstają w tle
         if use_claude_api:
-            try:
-                print(f"🤖 Generating AI questions for category: {category_name}")
-                
-                # Generuj pytania przez Claude API
-                questions_data = generate_questions_with_claude(
-                    category_name, 
-                    difficulty, 
-                    num_questions=10
-                )
-
-                print(f"✅ Generated {len(questions_data)} questions")
-
-                # Dodaj pytania do bazy
-                questions_added = 0
-                for q_data in questions_data:
-                    question = AIQuestion(
-                        category_id=new_category.id,
-                        question_text=q_data['q'],
-                        option_a=q_data['a'],
-                        option_b=q_data['b'],
-                        option_c=q_data['c'],
-                        correct_answer=q_data['correct'],
-                        difficulty=difficulty
-                    )
-                    db.session.add(question)
-                    questions_added += 1
-
-                db.session.commit()
-                
+            from_pool = take_from_pool(new_category, AI_QUESTIONS_PER_CATEGORY)
+            db.session.commit()
+            invalidate_ai_catalog()
+            shortfall = AI_QUESTIONS_PER_CATEGORY - from_pool
+            if shortfall <= 0:
                 return jsonify({
-                    'message': f'Kategoria "{category_name}" utworzona z {questions_added} pytaniami wygenerowanymi przez AI!',
+                    'message': f'Kategoria "{category_name}" utworzona z {from_pool} pytaniami AI z puli!',
                     'category_id': new_category.id,
-                    'questions_generated': questions_added
+                    'questions_from_pool': from_pool
                 })
-                
-            except Exception as e:
-                db.session.rollback()
-                error_msg = str(e)
-                print(f"❌ Error generating questions: {error_msg}")
-                
-                # Zwróć bardziej szczegółowy błąd
-                return jsonify({
-                    'error': f'Błąd podczas generowania pytań: {error_msg}'
-                }), 500
+            job = submit_generation_job(new_category, shortfall)
+            return jsonify({
+                'message': f'Kategoria "{category_name}" utworzona ({from_pool} pytań z puli). Pozostałe pytania są generowane przez AI w tle...',
+                'category_id': new_category.id,
+                'questions_from_pool': from_pool,
+                'job_id': job.id
+            }), 202
         else:
             # Kategoria bez pytań (Admin może je później dodać)
             db.session.commit()
+            invalidate_ai_catalog()
             return jsonify({
                 'message': f'Kategoria "{category_name}" utworzona. Pytania można dodać w panelu Admin.',
                 'category_id': new_category.id
@@ -1045,6 +2208,16 @@ def add_custom_category():
         traceback.print_exc()
         return jsonify({'error': f'Błąd serwera: {error_msg}'}), 500
 
+@app.route('/api/host/ai-quiz/jobs/<int:job_id>', methods=['GET'])
+@host_required
+def get_generation_job(job_id):
+    """Status zadania generowania pytań (postęp jest też wysyłany przez Socket.IO)"""
+    job = db.session.get(AIGenerationJob, job_id)
+    if not job or job.event_id != session['host_event_id']:
+        return jsonify({'error': 'Zadanie nie istnieje'}), 404
+    category = db.session.get(AIQuizCategory, job.category_id)
+    return jsonify(generation_job_to_dict(job, category.name if category else None))
+
 @app.route('/api/host/ai-quiz/category/<int:category_id>', methods=['DELETE'])
 @host_required
 def delete_custom_category(category_id):
@@ -1060,8 +2233,10 @@ def delete_custom_category(category_id):
         return jsonify({'error': 'Brak uprawnień do usunięcia tej kategorii'}), 403
 
     category_name = category.name
+    invalidate_ai_question_decks([category_id])
     db.session.delete(category)
     db.session.commit()
+    invalidate_ai_catalog()
 
     return jsonify({'message': f'Kategoria "{category_name}" została usunięta'})
 
@@ -1098,25 +2273,35 @@ def start_game():
         Player.query.filter_by(event_id=event_id).delete()
         PlayerScan.query.filter_by(event_id=event_id).delete()
         PlayerAnswer.query.filter_by(event_id=event_id).delete()
+        QuestionDeck.query.filter_by(event_id=event_id).delete()
+        AIQuestionDeck.query.filter_by(event_id=event_id).delete()
+        FunnyPhotoVariant.query.filter_by(event_id=event_id).delete()
         FunnyPhoto.query.filter_by(event_id=event_id).delete()
         PhotoVote.query.filter_by(event_id=event_id).delete()
-        
-        set_game_state(event_id, 'game_active', 'True')
-        set_game_state(event_id, 'is_timer_running', 'True')
-        set_game_state(event_id, 'game_start_time', datetime.utcnow().isoformat())
-        set_game_state(event_id, 'total_paused_duration', 0)
-        set_game_state(event_id, 'bonus_multiplier', 1)
-        set_game_state(event_id, 'time_speed', 1)
+        ScoreAward.query.filter_by(event_id=event_id).delete()
+        # Przeładuj stan eventu z bazy (klucze minigier usuniętych graczy itp.)
+        invalidate_game_state(event_id)
+        invalidate_leaderboard(event_id)
+        invalidate_qr_codes(event_id)
+        invalidate_photo_feed(event_id)
         
         minutes = int(request.json.get('minutes', 30))
         duration_seconds = minutes * 60
-        set_game_state(event_id, 'initial_game_duration', duration_seconds)
-        end_time = datetime.utcnow() + timedelta(seconds=duration_seconds)
-        set_game_state(event_id, 'game_end_time', end_time.isoformat())
+        now = datetime.utcnow()
         
-        print(f"Game state set: active=True, timer_running=True, duration={minutes}min")
+        # Jeden commit: usunięcie danych graczy + nowy stan gry
+        set_game_states(event_id, {
+            'game_active': 'True',
+            'is_timer_running': 'True',
+            'game_start_time': now.isoformat(),
+            'total_paused_duration': 0,
+            'bonus_multiplier': 1,
+            'initial_game_duration': duration_seconds,
+            **timer_segment(duration_seconds, 1, now)
+        })
         
-        db.session.commit()
+        print(f"Game state set: active=True, timer_running=True, duration={minutes}min")
+        schedule_game_deadline(event_id)
         
         # ✅ POPRAWKA: Pobierz świeży stan i emituj SYNCHRONICZNIE
         room = f'event_{event_id}'
@@ -1156,8 +2341,8 @@ def stop_game():
     if not event.check_password(password):
         return jsonify({'error': 'Nieprawidłowe hasło!'}), 401
 
-    set_game_state(event_id, 'game_active', 'False')
-    set_game_state(event_id, 'is_timer_running', 'False')
+    set_game_states(event_id, {'game_active': 'False', 'is_timer_running': 'False'})
+    schedule_game_deadline(event_id)
     emit_full_state_update(f'event_{event_id}')
     return jsonify({'message': 'Gra została zatrzymana.'})
 
@@ -1175,32 +2360,34 @@ def game_control():
     if control == 'pause':
         if is_running:
             # ✅ PAUZOWANIE - zapisz dokładnie tyle czasu ile pokazuje zegar
-            set_game_state(event_id, 'is_timer_running', 'False')
-            set_game_state(event_id, 'pause_start_time', datetime.utcnow().isoformat())
-            end_time_str = get_game_state(event_id, 'game_end_time')
-            if end_time_str:
-                # Zapisz dokładnie ile sekund pozostało do końca
-                time_left = (datetime.fromisoformat(end_time_str) - datetime.utcnow()).total_seconds()
-                set_game_state(event_id, 'time_left_on_pause', time_left)
-                print(f"⏸️  Paused at: {time_left:.1f}s")
+            now = datetime.utcnow()
+            # Zapisz dokładnie ile sekund pozostało do końca
+            time_left = compute_time_left(event_id, now)
+            set_game_states(event_id, {
+                'is_timer_running': 'False',
+                'pause_start_time': now.isoformat(),
+                'time_left_on_pause': time_left
+            })
+            print(f"⏸️  Paused at: {time_left:.1f}s")
         else:
             # ✅ WZNOWIENIE - wznów dokładnie z tego samego momentu
+            now = datetime.utcnow()
+            updates = {}
             pause_start_str = get_game_state(event_id, 'pause_start_time')
             if pause_start_str:
-                paused_duration = (datetime.utcnow() - datetime.fromisoformat(pause_start_str)).total_seconds()
+                paused_duration = (now - datetime.fromisoformat(pause_start_str)).total_seconds()
                 total_paused = float(get_game_state(event_id, 'total_paused_duration', 0))
-                set_game_state(event_id, 'total_paused_duration', total_paused + paused_duration)
+                updates['total_paused_duration'] = total_paused + paused_duration
             
             # Pobierz dokładnie tyle czasu ile było podczas pauzy
             time_left = float(get_game_state(event_id, 'time_left_on_pause', 0))
+            current_speed = int(get_game_state(event_id, 'time_speed', 1))
             
-            # ✅ Wznów z dokładnie tego samego miejsca (bez przeliczania!)
-            # update_timers() zastosuje aktualną prędkość automatycznie
-            new_end_time = datetime.utcnow() + timedelta(seconds=time_left)
-            set_game_state(event_id, 'game_end_time', new_end_time.isoformat())
-            set_game_state(event_id, 'is_timer_running', 'True')
+            # ✅ Wznów z dokładnie tego samego miejsca - nowy segment z aktualną prędkością
+            updates.update(timer_segment(time_left, current_speed, now))
+            updates['is_timer_running'] = 'True'
+            set_game_states(event_id, updates)
             
-            current_speed = int(get_game_state(event_id, 'time_speed', 1))
             print(f"▶️  Resumed at: {time_left:.1f}s (speed x{current_speed})")
     
     elif control == 'speed':
@@ -1209,20 +2396,33 @@ def game_control():
         
         print(f"⚡ Speed change: {current_speed}x → {new_speed}x")
         
-        # ✅ TYLKO zmień prędkość
-        # NIE modyfikuj time_left_on_pause - to zatrzymany czas!
-        set_game_state(event_id, 'time_speed', new_speed)
-        
         if is_active and is_running:
-            print(f"   Running - update_timers() will apply x{new_speed}")
-        elif is_active and not is_running:
-            print(f"   Paused - x{new_speed} will be used after resume")        
+            # Zamknij bieżący segment i zacznij nowy z nową prędkością
+            now = datetime.utcnow()
+            set_game_states(event_id, timer_segment(compute_time_left(event_id, now), new_speed, now))
+            print(f"   Running - new timer segment at x{new_speed}")
+        else:
+            # ✅ TYLKO zmień prędkość
+            # NIE modyfikuj time_left_on_pause - to zatrzymany czas!
+            set_game_state(event_id, 'time_speed', new_speed)
+            if is_active:
+                print(f"   Paused - x{new_speed} will be used after resume")
+
     elif control == 'language_player':
         set_game_state(event_id, 'language_player', value)
 
     elif control == 'language_host':
         set_game_state(event_id, 'language_host', value)
     
+    elif control == 'emit_window':
+        # Okno łączenia emisji rankingu/hasła (ms) dla tego eventu
+        try:
+            window_ms = int(value)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Nieprawidłowe okno emisji (ms)'}), 400
+        set_game_state(event_id, 'emit_coalesce_ms', min(max(window_ms, 0), 2000))
+    
+    schedule_game_deadline(event_id)
     emit_full_state_update(f'event_{event_id}')
     return jsonify(get_full_game_state(event_id))
 
@@ -1255,26 +2455,27 @@ def adjust_time():
     is_running = get_game_state(event_id, 'is_timer_running', 'False') == 'True'
     
     try:
-        # Oblicz nowy end_time
         new_duration_seconds = int(new_minutes) * 60
+        now = datetime.utcnow()
+        current_speed = int(get_game_state(event_id, 'time_speed', 1))
+        
+        # Nowy segment czasu od teraz + initial_game_duration (dla statystyk)
+        updates = timer_segment(new_duration_seconds, current_speed, now)
+        updates['initial_game_duration'] = new_duration_seconds
         
         if is_running:
-            # ✅ Jeśli gra jest uruchomiona, ustaw nowy end_time od teraz
-            new_end_time = datetime.utcnow() + timedelta(seconds=new_duration_seconds)
-            set_game_state(event_id, 'game_end_time', new_end_time.isoformat())
-            print(f"⏰ Adjusted time while running: {new_minutes} min (new end: {new_end_time})")
+            # ✅ Jeśli gra jest uruchomiona, odliczanie rusza od nowej wartości
+            print(f"⏰ Adjusted time while running: {new_minutes} min (new end: {updates['game_end_time']})")
         else:
             # ✅ Jeśli gra jest zapauzowana, ustaw time_left_on_pause
-            set_game_state(event_id, 'time_left_on_pause', new_duration_seconds)
-            # Ustaw również game_end_time na przyszłość (będzie zaktualizowany przy wznowieniu)
-            new_end_time = datetime.utcnow() + timedelta(seconds=new_duration_seconds)
-            set_game_state(event_id, 'game_end_time', new_end_time.isoformat())
+            # (game_end_time zostanie przeliczony przy wznowieniu)
+            updates['time_left_on_pause'] = new_duration_seconds
             print(f"⏸️  Adjusted time while paused: {new_minutes} min (time_left_on_pause: {new_duration_seconds}s)")
         
-        # Aktualizuj initial_game_duration (dla statystyk)
-        set_game_state(event_id, 'initial_game_duration', new_duration_seconds)
+        set_game_states(event_id, updates)
         
         # Wyemituj aktualizację stanu
+        schedule_game_deadline(event_id)
         emit_full_state_update(f'event_{event_id}')
         
         return jsonify({'message': f'Czas gry został zmieniony na {new_minutes} minut.'})
@@ -1368,8 +2569,13 @@ def warn_player(player_id):
 def delete_player(player_id):
     player = db.session.get(Player, player_id)
     if player and player.event_id == session['host_event_id']:
+        QuestionDeck.query.filter_by(player_id=player_id).delete()
+        AIQuestionDeck.query.filter_by(player_id=player_id).delete()
+        ScoreAward.query.filter_by(player_id=player_id).delete()
         db.session.delete(player)
         db.session.commit()
+        remove_leaderboard_entry(player.event_id, player_id)
+        invalidate_photo_feed(player.event_id)  # zdjęcia gracza usuwa kaskada w bazie
         emit_leaderboard_update(f'event_{session["host_event_id"]}')
         return jsonify({'message': 'Gracz usunięty'})
     return jsonify({'error': 'Nie znaleziono gracza'}), 404
@@ -1439,6 +2645,7 @@ def host_questions():
         )
         db.session.add(new_q)
         db.session.commit()
+        bump_question_set_version(event_id)
         return jsonify({'id': new_q.id})
     
     questions = Question.query.filter_by(event_id=event_id).all()
@@ -1472,11 +2679,14 @@ def manage_question(question_id):
         q.category = data.get('category', q.category)
         q.difficulty = data.get('difficulty', q.difficulty)
         db.session.commit()
+        bump_question_set_version(q.event_id)
         return jsonify({'message': 'Pytanie zaktualizowane'})
     
     if request.method == 'DELETE':
+        event_id = q.event_id
         db.session.delete(q)
         db.session.commit()
+        bump_question_set_version(event_id)
         return jsonify({'message': 'Pytanie usunięte'})
 
 @app.route('/api/host/qrcodes/counts', methods=['GET'])
@@ -1520,6 +2730,7 @@ def host_generate_qr_codes():
             db.session.add(QRCode(code_identifier=f"{prefix}{i}", color=color, event_id=event_id))
     
     db.session.commit()
+    warm_qr_codes(event_id)
     return jsonify({'message': 'Kody QR zostały wygenerowane.'})
 
 # --- API: PLAYER ---
@@ -1532,6 +2743,7 @@ def register_player():
     new_player = Player(name=name, event_id=event_id)
     db.session.add(new_player)
     db.session.commit()
+    update_leaderboard_entry(new_player)
     emit_leaderboard_update(f'event_{event_id}')
     return jsonify({'id': new_player.id, 'name': new_player.name, 'score': 0})
 
@@ -1571,11 +2783,11 @@ def scan_qr():
         }), 400
     
     # Znajdź kod QR
-    qr_code = QRCode.query.filter_by(code_identifier=qr_id, event_id=event_id).first()
+    qr_code = get_qr_code_entry(event_id, qr_id)
     
     print(f"QR Code found: {qr_code is not None}")
     if qr_code:
-        print(f"QR Code color: {qr_code.color}")
+        print(f"QR Code color: {qr_code['color']}")
     
     if not qr_code:
         print(f"ERROR: QR code not found!")
@@ -1589,13 +2801,13 @@ def scan_qr():
         print(f"ERROR: Game not active!")
         return jsonify({'message': 'Gra nie jest aktywna.'}), 403
 
-    print(f"QR Code color check: {qr_code.color}")
+    print(f"QR Code color check: {qr_code['color']}")
 
     # BIAŁE I ŻÓŁTE KODY (wielorazowe - quizy)
-    if qr_code.color in ['white', 'yellow']:
+    if qr_code['color'] in ['white', 'yellow']:
         last_scan = PlayerScan.query.filter_by(
             player_id=player_id, 
-            color_category=qr_code.color
+            color_category=qr_code['color']
         ).order_by(PlayerScan.scan_time.desc()).first()
         
         if last_scan and datetime.utcnow() < last_scan.scan_time + timedelta(minutes=5):
@@ -1607,18 +2819,13 @@ def scan_qr():
         
         db.session.add(PlayerScan(
             player_id=player_id, 
-            qrcode_id=qr_code.id, 
+            qrcode_id=qr_code['id'], 
             event_id=event_id, 
-            color_category=qr_code.color
+            color_category=qr_code['color']
         ))
         
-        quiz_category = 'company' if qr_code.color == 'white' else 'world'
-        answered_ids = [ans.question_id for ans in PlayerAnswer.query.filter_by(player_id=player_id).all()]
-        question = Question.query.filter(
-            Question.id.notin_(answered_ids), 
-            Question.event_id == event_id, 
-            Question.category == quiz_category
-        ).order_by(db.func.random()).first()
+        quiz_category = 'company' if qr_code['color'] == 'white' else 'world'
+        question = draw_question(player_id, event_id, quiz_category)
         
         if not question:
             return jsonify({
@@ -1639,7 +2846,7 @@ def scan_qr():
         })
     
     # 🎮 ZIELONY KOD - MINIGRY (Tetris, Arkanoid lub Snake)
-    elif qr_code.color == 'green':
+    elif qr_code['color'] == 'green':
         print(f"=== GREEN CODE - MINIGAME MODE ===")
 
         # Sprawdź czy gry są aktywne
@@ -1723,36 +2930,48 @@ def scan_qr():
     
     # JEDNORAZOWE KODY (czerwone, pułapki, różowe)
     else:
-        if qr_code.claimed_by_player_id:
+        key = idempotency_key()
+        replay = replay_score_award(player_id, key)
+        if replay is not None:
+            return replay
+        if not claim_score_award(player, key):
+            return score_award_conflict(player_id, key)
+        if qr_code['claimed_by'] or not claim_qr_code(qr_code, player_id):
             return jsonify({
                 'status': 'error', 
                 'message': 'Ten kod został już wykorzystany.'
             }), 403
         
-        qr_code.claimed_by_player_id = player_id
-        
         # CZERWONY KOD
-        if qr_code.color == 'red':
-            player.score += 50
+        delta = 0
+        if qr_code['color'] == 'red':
+            delta = 50
             message = 'Kod specjalny! Zdobywasz 50 punktów!'
         
         # PUŁAPKA
-        elif qr_code.color == 'white_trap':
-            player.score = max(0, player.score - 25)
+        elif qr_code['color'] == 'white_trap':
+            delta = -25
             message = 'Pułapka! Tracisz 25 punktów.'
         
         # RÓŻOWY KOD - FOTO
-        elif qr_code.color == 'pink':
+        elif qr_code['color'] == 'pink':
+            store_score_response(player, key, 0, {'status': 'photo_challenge'})
             db.session.commit()
+            mark_qr_code_claimed(event_id, qr_id, player_id)
             return jsonify({'status': 'photo_challenge'})
         
         # NIEZNANY KOD
         else:
             message = "Niezidentyfikowany kod."
         
+        if delta:
+            apply_score_delta(player, delta)
+        payload = store_score_response(player, key, delta, {'status': 'info', 'message': message, 'score': player.score})
         db.session.commit()
+        mark_qr_code_claimed(event_id, qr_id, player_id)
+        update_leaderboard_entry(player)
         emit_leaderboard_update(f'event_{event_id}')
-        return jsonify({'status': 'info', 'message': message, 'score': player.score})
+        return jsonify(payload)
 
 @app.route('/api/player/answer', methods=['POST'])
 def process_answer():
@@ -1760,19 +2979,26 @@ def process_answer():
     player_id, question_id, answer = data.get('player_id'), data.get('question_id'), data.get('answer')
     player, question = db.session.get(Player, player_id), db.session.get(Question, question_id)
     if not player or not question: return jsonify({'error': 'Invalid data'}), 404
+    key = idempotency_key()
+    replay = replay_score_award(player_id, key)
+    if replay is not None:
+        return replay
+    if not claim_score_award(player, key):
+        return score_award_conflict(player_id, key)
     
     db.session.add(PlayerAnswer(player_id=player_id, question_id=question_id, event_id=player.event_id))
     bonus = int(get_game_state(player.event_id, 'bonus_multiplier', 1))
     
     # Zwiększ licznik wyświetleń
     question.times_shown += 1
+    staged = {}
     
     if answer == question.correct_answer:
         # Zwiększ licznik poprawnych odpowiedzi
         question.times_correct += 1
         
         points = 10 * bonus
-        player.score += points
+        apply_score_delta(player, points)
         
         # ✅ ZMODYFIKOWANA LOGIKA: Sprawdź tryb odkrywania hasła
         password_mode = get_game_state(player.event_id, 'password_reveal_mode', 'auto')
@@ -1798,75 +3024,335 @@ def process_answer():
                 
                 # Zapisz zaktualizowane indeksy
                 revealed_indices_str = ','.join(map(str, sorted(revealed_indices)))
-                set_game_state(player.event_id, 'revealed_password_indices', revealed_indices_str)
-                
-                emit_password_update(f'event_{player.event_id}')
+                staged = stage_game_states(player.event_id, {'revealed_password_indices': revealed_indices_str})
         
-        db.session.commit()
-        emit_leaderboard_update(f'event_{player.event_id}')
-        return jsonify({'correct': True, 'letter': question.letter_to_reveal, 'score': player.score})
+        payload = store_score_response(player, key, points, {'correct': True, 'letter': question.letter_to_reveal, 'score': player.score})
     else:
-        player.score = max(0, player.score - 5)
-        db.session.commit()
-        emit_leaderboard_update(f'event_{player.event_id}')
-        return jsonify({'correct': False, 'score': player.score})
+        apply_score_delta(player, -5)
+        payload = store_score_response(player, key, -5, {'correct': False, 'score': player.score})
+    # Jeden commit: klucz idempotencji, punkty, odpowiedź i odkryta litera
+    db.session.commit()
+    apply_game_states(player.event_id, staged)
+    if staged:
+        emit_password_update(f'event_{player.event_id}')
+    update_leaderboard_entry(player)
+    emit_leaderboard_update(f'event_{player.event_id}')
+    return jsonify(payload)
+
+# --- Zdjęcia graczy (upload i przetwarzanie w tle) ---
+# Upload zapisuje plik strumieniowo prosto do static/uploads/funny, a skalowanie, usunięcie EXIF,
+# konwersję do WebP i mniejsze szerokości (srcset) robią workery w puli wątków - poza greenletem żądania.
+PHOTO_WORKERS = max(1, int(os.environ.get('PHOTO_WORKERS', 2)))
+PHOTO_MAX_UPLOAD = int(os.environ.get('PHOTO_MAX_UPLOAD_MB', 15)) * 1024 * 1024
+PHOTO_MAX_SIZE = 1600  # dłuższy bok pełnej wersji zdjęcia (px)
+PHOTO_WIDTHS = (320, 640, 1280)  # mniejsze wersje dla srcset
+PHOTO_WEBP_QUALITY = 80
+PHOTO_CACHE_MAX_AGE = 365 * 24 * 3600  # nazwy plików są unikalne, treść się nie zmienia
+_photo_queue = queue.Queue()
+_pending_photos = defaultdict(int)  # player_id -> zdjęcia w kolejce (jeszcze bez FunnyPhoto)
+
+def _photo_upload_stream(total_content_length, content_type, filename=None, content_length=None):
+    """Pliki z formularza trafiają od razu na dysk (bez bufora w pamięci i bez kopii z /tmp)"""
+    return open(os.path.join(funny_folder, f"upload_{uuid.uuid4().hex}.part"), 'wb+')
+
+def _render_photo_derivatives(source_path, name):
+    """Wątek puli: pełna wersja (max PHOTO_MAX_SIZE) i mniejsze szerokości w WebP, bez EXIF.
+
+    Zwraca [(szerokość, nazwa pliku)] od największej; pierwsza pozycja to pełna wersja.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as original:
+        original.draft('RGB', (PHOTO_MAX_SIZE, PHOTO_MAX_SIZE))  # JPEG: dekodowanie od razu w mniejszej skali
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    image.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE))
+    variants = [(image.width, f"{name}.webp")]
+    image.save(os.path.join(funny_folder, variants[0][1]), 'WEBP', quality=PHOTO_WEBP_QUALITY)
+    # Każda mniejsza wersja skalowana z poprzedniej (szybciej niż z pełnej)
+    for width in sorted((w for w in PHOTO_WIDTHS if w < image.width), reverse=True):
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        variants.append((width, f"{name}_{width}w.webp"))
+        image.save(os.path.join(funny_folder, variants[-1][1]), 'WEBP', quality=PHOTO_WEBP_QUALITY)
+    return variants
+
+def photo_srcset(variants):
+    """Lista wersji zdjęcia dla srcset: [{'url', 'width'}] od najmniejszej"""
+    return [{'url': v.url, 'width': v.width} for v in sorted(variants, key=lambda v: v.width)]
+
+def process_photo_upload(job):
+    """Tworzy wersje zdjęcia w puli wątków, zapisuje FunnyPhoto i dopiero wtedy emituje new_photo"""
+    name = f"event_{job['event_id']}_{uuid.uuid4().hex}"
+    try:
+        rendered = gevent.get_hub().threadpool.apply(_render_photo_derivatives, (job['path'], name))
+    finally:
+        os.remove(job['path'])
+        _pending_photos[job['player_id']] -= 1
+
+    urls = [(width, f"/media/photos/{filename}") for width, filename in rendered]
+    photo = FunnyPhoto(player_id=job['player_id'], player_name=job['player_name'],
+                       image_url=urls[0][1], event_id=job['event_id'])
+    db.session.add(photo)
+    db.session.flush()
+    variants = [FunnyPhotoVariant(photo_id=photo.id, event_id=photo.event_id, width=width, url=url) for width, url in urls]
+    db.session.add_all(variants)
+    db.session.commit()
+    add_photo_to_feed(photo, variants)
+    socketio.emit('new_photo', {
+        'id': photo.id,
+        'url': photo.image_url,
+        'srcset': photo_srcset(variants),
+        'player': photo.player_name
+    }, room=f"event_{job['event_id']}")
+
+def photo_worker():
+    """Worker puli zdjęć - jedno zdjęcie naraz, ciężka praca w wątku, greenlet tylko czeka"""
+    while True:
+        job = _photo_queue.get()
+        with app.app_context():
+            try:
+                process_photo_upload(job)
+            except Exception as e:
+                print(f"❌ Photo worker error (player {job['player_id']}): {e}")
+            finally:
+                db.session.remove()
+
+@app.route('/media/photos/<path:filename>')
+def photo_file(filename):
+    """Pliki zdjęć (niezmienne, unikalne nazwy) z długim cache w przeglądarce ekranów"""
+    response = send_from_directory(os.path.abspath(funny_folder), filename, max_age=PHOTO_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={PHOTO_CACHE_MAX_AGE}, immutable'
+    return response
+
+@app.route('/api/player/upload_photo', methods=['POST'])
+def upload_photo():
+    """Zdjęcie z różowego kodu (multipart: photo, player_id) - odpowiedź od razu, obróbka w tle"""
+    if (request.content_length or 0) > PHOTO_MAX_UPLOAD:
+        return jsonify({'error': 'Zdjęcie jest za duże'}), 413
+    # Wszystkie pliki zapisane z tego żądania; poza przekazanym do workera usuwa je finally
+    created, queued = [], None
+    def stream_factory(*args, **kwargs):
+        stream = _photo_upload_stream(*args, **kwargs)
+        created.append(stream)
+        return stream
+
+    try:
+        try:
+            _, form, files = parse_form_data(request.environ, stream_factory=stream_factory,
+                                             max_content_length=PHOTO_MAX_UPLOAD)
+        except RequestEntityTooLarge:
+            return jsonify({'error': 'Zdjęcie jest za duże'}), 413
+
+        photo = files.get('photo')
+        if not photo:
+            return jsonify({'error': 'Brak zdjęcia'}), 400
+        photo.stream.close()
+        path = photo.stream.name
+
+        player = db.session.get(Player, form.get('player_id', type=int) or 0)
+        if not player:
+            return jsonify({'error': 'Nie znaleziono gracza'}), 404
+        # Każdy zajęty różowy kod to jedno zdjęcie
+        challenges = QRCode.query.filter_by(event_id=player.event_id, color='pink', claimed_by_player_id=player.id).count()
+        if FunnyPhoto.query.filter_by(player_id=player.id).count() + _pending_photos[player.id] >= challenges:
+            return jsonify({'error': 'Najpierw zeskanuj różowy kod'}), 403
+        try:
+            # Tylko nagłówek pliku - pełne dekodowanie w workerze
+            from PIL import Image
+            with Image.open(path):
+                pass
+        except Exception:
+            return jsonify({'error': 'Nieprawidłowy plik zdjęcia'}), 400
+
+        _pending_photos[player.id] += 1
+        _photo_queue.put({'path': path, 'player_id': player.id, 'player_name': player.name, 'event_id': player.event_id})
+        queued = path
+        return jsonify({
+            'status': 'processing',
+            'message': '📸 Zdjęcie wysłane! Za chwilę pojawi się na ekranie.',
+            'score': player.score
+        })
+    finally:
+        for stream in created:
+            stream.close()
+            if stream.name != queued and os.path.exists(stream.name):
+                os.remove(stream.name)
+
+# --- Galeria zdjęć (w pamięci) ---
+# event_id -> {
+#   'photos': {photo_id: zdjęcie w formacie API},
+#   'keys': {photo_id: klucz sortowania}, 'order': posortowane klucze (-votes, -timestamp, -id) - kolejność galerii,
+#   'ids': posortowane photo_id (kursor since),
+#   'views': {(since, limit): (payload, etag)} - gotowe odpowiedzi, czyszczone przy każdej zmianie
+# }
+PHOTO_FEED_MAX_LIMIT = 100
+PHOTO_FEED_MAX_VIEWS = 64
+_photo_feeds = {}
+
+def _photo_feed_put(feed, photo, variants):
+    feed['photos'][photo.id] = {
+        'id': photo.id,
+        'player_name': photo.player_name,
+        'image_url': photo.image_url,
+        'srcset': photo_srcset(variants),
+        'votes': photo.votes or 0,
+        'timestamp': photo.timestamp.isoformat()
+    }
+    feed['keys'][photo.id] = (-(photo.votes or 0), -photo.timestamp.timestamp(), -photo.id)
+
+def _get_photo_feed(event_id):
+    event_id = _state_event_id(event_id)
+    feed = _photo_feeds.get(event_id)
+    if feed is None:
+        variants = defaultdict(list)
+        for variant in FunnyPhotoVariant.query.filter_by(event_id=event_id):
+            variants[variant.photo_id].append(variant)
+        feed = {'photos': {}, 'keys': {}, 'views': {}}
+        for photo in FunnyPhoto.query.filter_by(event_id=event_id):
+            _photo_feed_put(feed, photo, variants[photo.id])
+        feed['order'] = sorted(feed['keys'].values())
+        feed['ids'] = sorted(feed['photos'])
+        _photo_feeds[event_id] = feed
+    return feed
+
+def add_photo_to_feed(photo, variants):
+    """Dopisuje nowe zdjęcie do załadowanej galerii (po commicie)"""
+    feed = _photo_feeds.get(photo.event_id)
+    if feed is not None and photo.id not in feed['photos']:
+        _photo_feed_put(feed, photo, variants)
+        bisect.insort(feed['order'], feed['keys'][photo.id])
+        bisect.insort(feed['ids'], photo.id)
+        feed['views'].clear()
+    publish_cluster_event('photos', photo.event_id)
+
+def _set_feed_votes(event_id, photo_id, votes):
+    feed = _photo_feeds.get(_state_event_id(event_id))
+    if feed is not None and photo_id in feed['photos'] and feed['photos'][photo_id]['votes'] != votes:
+        old_key = feed['keys'][photo_id]
+        del feed['order'][bisect.bisect_left(feed['order'], old_key)]
+        new_key = (-votes,) + old_key[1:]
+        feed['keys'][photo_id] = new_key
+        bisect.insort(feed['order'], new_key)
+        feed['photos'][photo_id]['votes'] = votes
+        feed['views'].clear()
+
+def update_photo_votes(event_id, photo_id, votes):
+    """Przesuwa zdjęcie w kolejności galerii po zmianie liczby głosów (po commicie)"""
+    _set_feed_votes(event_id, photo_id, votes)
+    publish_cluster_event('photo_votes', event_id, {'photo_id': photo_id, 'votes': votes})
+
+def invalidate_photo_feed(event_id):
+    _photo_feeds.pop(_state_event_id(event_id), None)
+    publish_cluster_event('photos', event_id)
+
+def photo_feed_view(event_id, since=None, limit=None):
+    """Zwraca (payload, etag): bez since - galeria wg głosów, z since - zdjęcia o id > since rosnąco"""
+    feed = _get_photo_feed(event_id)
+    key = (since, limit)
+    view = feed['views'].get(key)
+    if view is None:
+        if since is None:
+            payload = [feed['photos'][-photo_key[2]] for photo_key in feed['order'][:limit]]
+        else:
+            start = bisect.bisect_right(feed['ids'], since)
+            page = feed['ids'][start:start + limit] if limit else feed['ids'][start:]
+            payload = {
+                'photos': [feed['photos'][photo_id] for photo_id in page],
+                'next_since': page[-1] if page else since,
+                'has_more': start + len(page) < len(feed['ids'])
+            }
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+        if len(feed['views']) >= PHOTO_FEED_MAX_VIEWS:
+            feed['views'].clear()
+        view = feed['views'][key] = (payload, etag)
+    return view
+
+# --- Głosy na zdjęcia ---
+# Licznik FunnyPhoto.votes zmienia się tylko atomowym UPDATE votes = votes ± 1 o tyle, ile wierszy
+# PhotoVote faktycznie dodano/usunięto - unikalność (photo_id, player_id) pilnuje podwójnych głosów.
+# Zmiany licznika trafiają do ekranów łącznie, raz na okno emisji (photo_votes_update).
+_pending_photo_votes = {}  # room -> {photo_id: votes}
+
+def set_photo_vote(photo_id, player_id, event_id, vote):
+    """Ustawia głos gracza (True - oddany, False - cofnięty) i zwraca zmianę licznika (-1, 0, 1).
+
+    Wywołanie idempotentne: powtórzone żądanie albo równoległe kliknięcie nic nie zmienia.
+    Nie commituje - licznik i wiersz głosu zapisują się w jednej transakcji wywołującego.
+    """
+    if vote:
+        values = {'photo_id': photo_id, 'player_id': player_id, 'event_id': event_id, 'timestamp': datetime.utcnow()}
+        stmt = _insert_on_conflict_do_nothing(PhotoVote.__table__, values, ['photo_id', 'player_id'])
+        if stmt is None:
+            if PhotoVote.query.filter_by(photo_id=photo_id, player_id=player_id).first():
+                return 0
+            stmt = db.insert(PhotoVote).values(values)
+        delta = db.session.execute(stmt).rowcount
+    else:
+        delta = -db.session.execute(db.delete(PhotoVote).where(
+            PhotoVote.photo_id == photo_id, PhotoVote.player_id == player_id)).rowcount
+    if delta:
+        db.session.execute(db.update(FunnyPhoto).where(FunnyPhoto.id == photo_id)
+                           .values(votes=FunnyPhoto.votes + delta))
+    return delta
+
+def emit_photo_votes_update(event_id, photo_id, votes):
+    room = f'event_{event_id}'
+    _pending_photo_votes.setdefault(room, {})[photo_id] = votes
+    schedule_emit(room, 'photo_votes')
 
 # 🎉 ENDPOINTY DLA GŁOSOWANIA NA ZDJĘCIA
 
 @app.route('/api/photos/<int:event_id>', methods=['GET'])
 def get_photos(event_id):
-    """Pobierz wszystkie zdjęcia dla danego eventu z liczbą głosów"""
-    photos = FunnyPhoto.query.filter_by(event_id=event_id).order_by(FunnyPhoto.votes.desc(), FunnyPhoto.timestamp.desc()).all()
-    return jsonify([{
-        'id': p.id,
-        'player_name': p.player_name,
-        'image_url': p.image_url,
-        'votes': p.votes,
-        'timestamp': p.timestamp.isoformat()
-    } for p in photos])
+    """Zdjęcia eventu z liczbą głosów i wersjami do srcset (ETag/304).
+
+    Bez parametrów: lista wg głosów (limit - pierwsze N). ?since=<id>&limit=N: kolejne zdjęcia
+    o id > since rosnąco jako {'photos', 'next_since', 'has_more'} - ekrany dociągają tylko nowe.
+    """
+    since = request.args.get('since', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = min(max(limit, 1), PHOTO_FEED_MAX_LIMIT)
+    elif since is not None:
+        limit = PHOTO_FEED_MAX_LIMIT
+
+    payload, etag = photo_feed_view(event_id, since, limit)
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/photo/<int:photo_id>/vote', methods=['POST'])
 def vote_photo(photo_id):
-    """Zagłosuj na zdjęcie (lub cofnij głos)"""
+    """Zagłosuj na zdjęcie (lub cofnij głos); opcjonalne 'vote': true/false ustawia stan zamiast przełączać"""
     data = request.json
     player_id = data.get('player_id')
     
     if not player_id:
         return jsonify({'error': 'Brak ID gracza'}), 400
     
-    player = db.session.get(Player, player_id)
-    photo = db.session.get(FunnyPhoto, photo_id)
+    player_event_id = db.session.query(Player.event_id).filter_by(id=player_id).scalar()
+    photo_event_id = db.session.query(FunnyPhoto.event_id).filter_by(id=photo_id).scalar()
     
-    if not player or not photo:
+    if player_event_id is None or photo_event_id is None or player_event_id != photo_event_id:
         return jsonify({'error': 'Nie znaleziono gracza lub zdjęcia'}), 404
     
-    # Sprawdź czy gracz już głosował na to zdjęcie
-    existing_vote = PhotoVote.query.filter_by(photo_id=photo_id, player_id=player_id).first()
-    
-    if existing_vote:
-        # Cofnij głos
-        db.session.delete(existing_vote)
-        photo.votes = max(0, photo.votes - 1)
-        action = 'removed'
+    vote = data.get('vote')
+    if vote is None:
+        # Przełącznik: najpierw próba cofnięcia głosu, a jeśli go nie było - oddanie
+        delta = set_photo_vote(photo_id, player_id, photo_event_id, False) or \
+            set_photo_vote(photo_id, player_id, photo_event_id, True)
+        action = 'removed' if delta < 0 else 'added'
     else:
-        # Dodaj głos
-        new_vote = PhotoVote(photo_id=photo_id, player_id=player_id, event_id=photo.event_id)
-        db.session.add(new_vote)
-        photo.votes += 1
-        action = 'added'
-    
+        set_photo_vote(photo_id, player_id, photo_event_id, bool(vote))
+        action = 'added' if vote else 'removed'
+    votes = db.session.query(FunnyPhoto.votes).filter_by(id=photo_id).scalar() or 0
     db.session.commit()
     
-    # Wyemituj aktualizację do wszystkich
-    room = f'event_{photo.event_id}'
-    socketio.emit('photo_vote_update', {
-        'photo_id': photo_id, 
-        'votes': photo.votes
-    }, room=room)
+    update_photo_votes(photo_event_id, photo_id, votes)
+    emit_photo_votes_update(photo_event_id, photo_id, votes)
     
     return jsonify({
         'action': action,
-        'votes': photo.votes,
+        'votes': votes,
         'message': 'Głos oddany!' if action == 'added' else 'Głos cofnięty'
     })
 
@@ -1876,6 +3362,13 @@ def check_vote(photo_id, player_id):
     vote = PhotoVote.query.filter_by(photo_id=photo_id, player_id=player_id).first()
     return jsonify({'voted': vote is not None})
 
+@app.route('/api/photos/<int:event_id>/votes/<int:player_id>', methods=['GET'])
+def get_player_photo_votes(event_id, player_id):
+    """Zdjęcia eventu, na które gracz zagłosował - jedno zapytanie zamiast check_vote dla każdego zdjęcia"""
+    photo_ids = [photo_id for photo_id, in db.session.query(PhotoVote.photo_id)
+                 .filter_by(player_id=player_id, event_id=event_id).order_by(PhotoVote.photo_id)]
+    return jsonify({'photo_ids': photo_ids})
+
 @app.route('/api/player/minigame/complete', methods=['POST'])
 def complete_minigame():
     data = request.json
@@ -1886,6 +3379,10 @@ def complete_minigame():
     player = db.session.get(Player, player_id)
     if not player:
         return jsonify({'error': 'Nie znaleziono gracza'}), 404
+    key = idempotency_key()
+    replay = replay_score_award(player_id, key)
+    if replay is not None:
+        return replay
     
     # Sprawdź czy minigra jest aktywna
     if game_type == 'tetris':
@@ -1905,13 +3402,15 @@ def complete_minigame():
         score_key = f'minigame_snake_score_{player_id}'
     else:
         return jsonify({'error': 'Nieznany typ minigry'}), 400
+    if not claim_score_award(player, key):
+        return score_award_conflict(player_id, key)
 
     # Pobierz aktualny wynik gracza w tej minigrze
     current_score = int(get_game_state(player.event_id, score_key, '0'))
 
     # Dodaj zdobyte punkty do sumy
     new_score = current_score + score
-    set_game_state(player.event_id, score_key, str(new_score))
+    staged = stage_game_states(player.event_id, {score_key: new_score})
 
     game_name = 'Tetris' if game_type == 'tetris' else ('Arkanoid' if game_type == 'arkanoid' else 'Snake')
     
@@ -1920,7 +3419,7 @@ def complete_minigame():
         # Gracz ukończył wyzwanie - przyznaj nagrody
         bonus = int(get_game_state(player.event_id, 'bonus_multiplier', 1))
         points = 10 * bonus
-        player.score += points
+        apply_score_delta(player, points)
         
         password = "SAPEREVENT"
         available_letters = [l for l in password if l not in player.revealed_letters.upper()]
@@ -1930,11 +3429,7 @@ def complete_minigame():
         else:
             revealed_letter = None
         
-        db.session.commit()
-        emit_password_update(f'event_{player.event_id}')
-        emit_leaderboard_update(f'event_{player.event_id}')
-        
-        return jsonify({
+        payload = store_score_response(player, key, points, {
             'success': True,
             'completed': True,
             'points_earned': points,
@@ -1945,8 +3440,7 @@ def complete_minigame():
         })
     else:
         # Gracz jeszcze nie osiągnął 20 punktów - może kontynuować
-        db.session.commit()
-        return jsonify({
+        payload = store_score_response(player, key, 0, {
             'success': True,
             'completed': False,
             'points_earned': 0,
@@ -1955,32 +3449,33 @@ def complete_minigame():
             'message': f'Postęp w {game_name}: {new_score}/20 pkt. Zeskanuj kod ponownie, aby kontynuować!'
         })
 
+    # Jeden commit: klucz idempotencji, postęp w minigrze i punkty
+    db.session.commit()
+    apply_game_states(player.event_id, staged)
+    if payload['completed']:
+        update_leaderboard_entry(player)
+        emit_password_update(f'event_{player.event_id}')
+        emit_leaderboard_update(f'event_{player.event_id}')
+    return jsonify(payload)
+
 # --- API: PLAYER - AI QUIZ ---
 @app.route('/api/player/ai-quiz/categories/<int:event_id>', methods=['GET'])
 def get_player_ai_categories(event_id):
-    """Zwraca aktywne kategorie AI Quiz dla gracza"""
-    # Pobierz aktywne domyślne kategorie
-    default_categories = AIQuizCategory.query.filter_by(
-        is_default=True,
-        is_active=True,
-        event_id=None
-    ).all()
-
-    # Pobierz aktywne custom kategorie dla tego eventu
-    custom_categories = AIQuizCategory.query.filter_by(
-        is_custom=True,
-        is_active=True,
-        event_id=event_id
-    ).all()
-
-    all_categories = default_categories + custom_categories
-
-    return jsonify([{
-        'id': cat.id,
-        'name': cat.name,
-        'difficulty': cat.difficulty,
-        'is_custom': cat.is_custom
-    } for cat in all_categories])
+    """Zwraca aktywne kategorie AI Quiz dla gracza (ETag - przeglądarka dostaje 304, gdy nic się nie zmieniło)"""
+    def build(catalog):
+        default_categories, custom_categories = _event_ai_categories(catalog, event_id)
+        return [{
+            'id': cat['id'],
+            'name': cat['name'],
+            'difficulty': cat['difficulty'],
+            'is_custom': cat['is_custom']
+        } for cat in default_categories + custom_categories if cat['is_active']]
+
+    payload, etag = ai_catalog_view(('player', event_id), build)
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/player/ai-quiz/question', methods=['POST'])
 def get_ai_quiz_question():
@@ -2002,29 +3497,15 @@ def get_ai_quiz_question():
     if category.is_custom and category.event_id != event_id:
         return jsonify({'error': 'Kategoria nie należy do tego eventu'}), 403
 
-    # Pobierz pytania już odpowiedziane przez gracza
-    answered_question_ids = db.session.query(AIPlayerAnswer.ai_question_id).filter_by(
-        player_id=player_id,
-        event_id=event_id
-    ).all()
-    answered_ids = [q[0] for q in answered_question_ids]
-
-    # Pobierz pytania z kategorii, które gracz jeszcze nie widział
-    available_questions = AIQuestion.query.filter(
-        AIQuestion.category_id == category_id,
-        ~AIQuestion.id.in_(answered_ids) if answered_ids else True
-    ).all()
+    # Kolejne pytanie z talii gracza (bez pytań, na które już odpowiedział)
+    question = draw_ai_question(player_id, event_id, category_id)
 
-    if not available_questions:
+    if not question:
         return jsonify({
             'error': 'Odpowiedziałeś już na wszystkie pytania z tej kategorii!',
             'all_answered': True
         }), 404
 
-    # Wybierz losowe pytanie
-    import random
-    question = random.choice(available_questions)
-
     # Zwiększ licznik wyświetleń
     question.times_shown += 1
     db.session.commit()
@@ -2056,6 +3537,10 @@ def submit_ai_quiz_answer():
     question = db.session.get(AIQuestion, question_id)
     if not question:
         return jsonify({'error': 'Pytanie nie istnieje'}), 404
+    key = idempotency_key()
+    replay = replay_score_award(player_id, key)
+    if replay is not None:
+        return replay
 
     # Sprawdź czy gracz już odpowiedział na to pytanie
     existing_answer = AIPlayerAnswer.query.filter_by(
@@ -2066,6 +3551,8 @@ def submit_ai_quiz_answer():
 
     if existing_answer:
         return jsonify({'error': 'Już odpowiedziałeś na to pytanie'}), 409
+    if not claim_score_award(player, key):
+        return score_award_conflict(player_id, key)
 
     # Zapisz odpowiedź gracza
     player_answer = AIPlayerAnswer(
@@ -2085,30 +3572,30 @@ def submit_ai_quiz_answer():
         # Przyznaj 5 punktów za poprawną odpowiedź
         bonus = int(get_game_state(event_id, 'bonus_multiplier', 1))
         points = 5 * bonus
-        player.score += points
-
-        db.session.commit()
-
-        # Emituj aktualizację tablicy
-        emit_leaderboard_update(f'event_{event_id}')
-
-        return jsonify({
+        apply_score_delta(player, points)
+        payload = store_score_response(player, key, points, {
             'correct': True,
             'points_earned': points,
             'total_score': player.score,
             'correct_answer': question.correct_answer,
             'message': f'Brawo! Poprawna odpowiedź! +{points} pkt'
         })
-    else:
         db.session.commit()
+        update_leaderboard_entry(player)
 
-        return jsonify({
+        # Emituj aktualizację tablicy
+        emit_leaderboard_update(f'event_{event_id}')
+        return jsonify(payload)
+    else:
+        payload = store_score_response(player, key, 0, {
             'correct': False,
             'points_earned': 0,
             'total_score': player.score,
             'correct_answer': question.correct_answer,
             'message': f'Niestety, zła odpowiedź. Poprawna to: {question.correct_answer}'
         })
+        db.session.commit()
+        return jsonify(payload)
 
 # --- API: PASSWORD MANAGEMENT ---
 @app.route('/api/host/password/set', methods=['POST'])
@@ -2130,8 +3617,7 @@ def set_password():
     if len(new_password) > 50:
         return jsonify({'error': 'Hasło może mieć maksymalnie 50 znaków'}), 400
     
-    set_game_state(event_id, 'game_password', new_password)
-    set_game_state(event_id, 'revealed_password_indices', '')
+    set_game_states(event_id, {'game_password': new_password, 'revealed_password_indices': ''})
     
     emit_password_update(f'event_{event_id}')
     
@@ -2230,19 +3716,21 @@ def get_password_state():
 # Dodaj zaraz po @app.route('/')
 @app.route('/health')
 def health_check():
-    """Health check endpoint dla Fly.io"""
+    """Health check endpoint dla Fly.io - 503, dopóki trwa rozgrzewka procesu"""
     try:
         # Sprawdź połączenie z bazą
-        db.session.execute('SELECT 1')
+        db.session.execute(db.text('SELECT 1'))
         db_status = 'connected'
     except:
         db_status = 'disconnected'
 
+    warming = _warmup['status'] == 'warming'
     return jsonify({
-        'status': 'healthy',
+        'status': 'warming' if warming else 'healthy',
         'service': 'SAPER QR',
-        'database': db_status
-    }), 200
+        'database': db_status,
+        'warmup': _warmup
+    }), 503 if warming else 200
 
 @app.route('/debug/template-info')
 def debug_template_info():
@@ -2352,115 +3840,413 @@ def emit_full_state_update(room):
     
     socketio.emit('game_state_update', state, room=room)
 
+# --- Łączenie emisji (coalescing) ---
+# room -> zbiór rodzajów emisji oczekujących na wysłanie. Pierwsze zgłoszenie uruchamia
+# greenlet, który po upływie okna eventu wysyła każdy rodzaj raz - 100 odpowiedzi
+# w sekundzie daje kilka broadcastów zamiast setek.
+_pending_emits = {}
+
+def _emit_window(event_id):
+    """Okno łączenia emisji eventu w sekundach"""
+    try:
+        return max(0, int(get_game_state(event_id, 'emit_coalesce_ms', app.config['EMIT_COALESCE_MS']))) / 1000
+    except (TypeError, ValueError):
+        return app.config['EMIT_COALESCE_MS'] / 1000
+
+def schedule_emit(room, kind):
+    """Oznacza emisję `kind` ('leaderboard', 'password', 'photo_votes') jako do wysłania w najbliższym oknie"""
+    pending = _pending_emits.get(room)
+    if pending is not None:
+        pending.add(kind)
+        return
+    window = _emit_window(int(room.split('_')[1]))
+    if window <= 0:
+        _EMITTERS[kind](room)
+        return
+    _pending_emits[room] = {kind}
+    socketio.start_background_task(_flush_emits, room, window)
+
+def _flush_emits(room, window):
+    socketio.sleep(window)
+    kinds = _pending_emits.pop(room, set())
+    with app.app_context():
+        for kind in ('password', 'leaderboard', 'photo_votes'):
+            if kind in kinds:
+                try:
+                    _EMITTERS[kind](room)
+                except Exception as e:
+                    print(f"❌ Błąd emisji {kind} do {room}: {e}")
+
 def emit_leaderboard_update(room):
+    schedule_emit(room, 'leaderboard')
+
+def emit_password_update(room):
+    schedule_emit(room, 'password')
+
+def _emit_leaderboard_now(room):
+    """Wysyła zmiany w rankingu: delty (leaderboard_delta) lub co jakiś czas pełny snapshot (leaderboard_update)"""
     event_id = int(room.split('_')[1])
     with app.app_context():
-        players = Player.query.filter_by(event_id=event_id).order_by(Player.score.desc()).all()
-        socketio.emit('leaderboard_update', [{'name': p.name, 'score': p.score} for p in players], room=room)
+        board = _get_leaderboard(event_id)
+        if board['snapshot_due'] or board['deltas'] >= app.config['LEADERBOARD_SNAPSHOT_EVERY']:
+            socketio.emit('leaderboard_update', leaderboard_snapshot(event_id), room=room)
+            board['deltas'] = 0
+            board['snapshot_due'] = False
+        elif board['changed'] or board['removed']:
+            players, order = board['players'], board['order']
+            changes = []
+            for player_id in board['changed']:
+                if player_id not in players:
+                    continue  # usunięty w międzyczasie (np. przez inny proces)
+                name, score = players[player_id]
+                rank = bisect.bisect_left(order, (-score, player_id)) + 1
+                changes.append({'id': player_id, 'name': name, 'score': score, 'rank': rank})
+            socketio.emit('leaderboard_delta', {
+                'changes': sorted(changes, key=lambda c: c['rank']),
+                'removed': sorted(board['removed']),
+                'player_count': len(players)
+            }, room=room)
+            board['deltas'] += 1
+        board['changed'].clear()
+        board['removed'].clear()
+
+def _emit_password_now(room):
+    event_id = int(room.split('_')[1])
+    with app.app_context():
+        socketio.emit('password_update', get_displayed_password(event_id), room=room)
+
+def _emit_photo_votes_now(room):
+    """Jedna emisja ze wszystkimi zmienionymi licznikami głosów z okna"""
+    votes = _pending_photo_votes.pop(room, {})
+    if votes:
+        socketio.emit('photo_votes_update', {
+            'votes': [{'photo_id': photo_id, 'votes': count} for photo_id, count in sorted(votes.items())]
+        }, room=room)
+
+_EMITTERS = {
+    'leaderboard': _emit_leaderboard_now,
+    'password': _emit_password_now,
+    'photo_votes': _emit_photo_votes_now
+}
+
+# --- Tryb wielu procesów (SOCKETIO_MESSAGE_QUEUE) ---
+# Procesy wymieniają przez Redis pub/sub informacje o zmianach stanu i rankingu, żeby cache
+# w pamięci każdego z nich był aktualny. Harmonogram końca gier i timer_tick działają tylko
+# w jednym procesie - liderze, wybranym przez klucz Redis z TTL odnawiany co kilka sekund.
+CLUSTER_CHANNEL = 'saper:cluster'
+TIMER_LEADER_KEY = 'saper:timer-leader'
+TIMER_LEADER_TTL = 15
+
+_cluster_redis = None
+_is_timer_leader = message_queue is None  # bez kolejki jedyny proces jest liderem
+
+def _cluster_node_id():
+    # Wyliczane przy każdym wywołaniu - worker gunicorna dostaje nowy PID po forku
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _get_cluster_redis():
+    global _cluster_redis
+    if message_queue and _cluster_redis is None:
+        import redis
+        _cluster_redis = redis.Redis.from_url(message_queue)
+    return _cluster_redis
+
+def publish_cluster_event(kind, event_id, payload=None):
+    """Powiadamia pozostałe procesy o zmianie (no-op w trybie jednego procesu)"""
+    if not message_queue:
+        return
+    try:
+        _get_cluster_redis().publish(CLUSTER_CHANNEL, json.dumps({
+            'origin': _cluster_node_id(),
+            'kind': kind,
+            'event_id': event_id,
+            **(payload or {})
+        }))
+    except Exception as e:
+        print(f"❌ Błąd publikacji zdarzenia klastra: {e}")
 
-def emit_password_update(room):
-     event_id = int(room.split('_')[1])
-     with app.app_context():
-        socketio.emit('password_update', get_full_game_state(event_id)['password'], room=room)
+def _apply_cluster_event(data):
+    global _ai_catalog
+    event_id = data.get('event_id')
+    kind = data.get('kind')
+    if kind == 'state':
+        _drop_game_state(event_id)
+        if event_id is not None:
+            schedule_game_deadline(event_id)
+    elif kind == 'leaderboard_reset':
+        _leaderboards.pop(_state_event_id(event_id), None)
+    elif kind == 'ai_catalog':
+        _ai_catalog = None
+    elif kind == 'qr_reset':
+        _qr_code_cache.pop(_state_event_id(event_id), None)
+    elif kind == 'photos':
+        _photo_feeds.pop(_state_event_id(event_id), None)
+    elif kind == 'photo_votes':
+        _set_feed_votes(event_id, data['photo_id'], data['votes'])
+    elif kind == 'qr_claim':
+        codes = _qr_code_cache.get(_state_event_id(event_id))
+        if codes is not None and data['code'] in codes:
+            codes[data['code']]['claimed_by'] = data['player_id']
+    else:
+        # Aktualizuj ranking tylko jeśli jest już załadowany - inaczej zostanie wczytany z bazy
+        board = _leaderboards.get(_state_event_id(event_id))
+        if board is None:
+            return
+        if kind == 'leaderboard':
+            _set_leaderboard_entry(board, data['player_id'], data['name'], data['score'])
+        elif kind == 'leaderboard_remove':
+            if _leaderboard_unlink(board, data['player_id']) is not None:
+                board['changed'].discard(data['player_id'])
+                board['removed'].add(data['player_id'])
+
+def cluster_listener():
+    """Background task - odbiera zmiany z innych procesów"""
+    print("🚀 Cluster listener started")
+    while True:
+        try:
+            pubsub = _get_cluster_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CLUSTER_CHANNEL)
+            for message in pubsub.listen():
+                data = json.loads(message['data'])
+                if data.get('origin') == _cluster_node_id():
+                    continue
+                with app.app_context():
+                    _apply_cluster_event(data)
+        except Exception as e:
+            print(f"❌ Błąd w cluster_listener: {e}")
+            socketio.sleep(1)
+
+_RENEW_LEADER_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def timer_leader_election():
+    """Background task - utrzymuje (lub przejmuje) rolę lidera dla zadań zegara"""
+    global _is_timer_leader
+    print("🚀 Timer leader election started")
+    while True:
+        try:
+            r = _get_cluster_redis()
+            node_id = _cluster_node_id()
+            is_leader = bool(r.set(TIMER_LEADER_KEY, node_id, nx=True, ex=TIMER_LEADER_TTL)) or \
+                bool(r.eval(_RENEW_LEADER_SCRIPT, 1, TIMER_LEADER_KEY, node_id, TIMER_LEADER_TTL))
+            if is_leader and not _is_timer_leader:
+                print(f"👑 {node_id} is now the timer leader")
+                # Przeładuj terminy wszystkich uruchomionych gier
+                with app.app_context():
+                    _load_game_deadlines()
+                _scheduler_wakeup.set()
+                _ticker_wakeup.set()
+            elif not is_leader and _is_timer_leader:
+                print(f"⚠️  {node_id} lost timer leadership")
+            _is_timer_leader = is_leader
+            if is_leader:
+                # Zadania AI procesów, które przestały odświeżać lease (zatrzymana maszyna, restart)
+                with app.app_context():
+                    try:
+                        resume_generation_jobs(expired_only=True)
+                    finally:
+                        db.session.remove()
+        except Exception as e:
+            print(f"❌ Błąd w timer_leader_election: {e}")
+            _is_timer_leader = False
+        socketio.sleep(TIMER_LEADER_TTL / 3)
 
 _background_task_started = False
 _background_task_lock = False
 
+# --- Harmonogram końca gry ---
+# Kopiec (end_time, event_id) z terminami końca uruchomionych gier. Aktualny termin eventu
+# jest w _game_deadlines - wpisy w kopcu, które się z nim nie zgadzają, są nieaktualne.
+# Harmonogram jest przebudowywany przy starcie/stopie/pauzie/wznowieniu/zmianie prędkości/czasu.
+_deadline_heap = []
+_game_deadlines = {}
+_ticking_events = set()
+_scheduler_wakeup = threading.Event()
+_ticker_wakeup = threading.Event()
+
+def schedule_game_deadline(event_id):
+    """Przelicza termin końca gry eventu na podstawie stanu (z cache) i budzi harmonogram"""
+    event_id = _state_event_id(event_id)
+    is_active = get_game_state(event_id, 'game_active', 'False') == 'True'
+    is_running = get_game_state(event_id, 'is_timer_running', 'False') == 'True'
+
+    if is_active and is_running:
+        now = datetime.utcnow()
+        speed = max(int(get_game_state(event_id, 'time_speed', 1)), 1)
+        end_time = now + timedelta(seconds=compute_time_left(event_id, now) / speed)
+        _game_deadlines[event_id] = end_time
+        heapq.heappush(_deadline_heap, (end_time, event_id))
+        _ticking_events.add(event_id)
+        _ticker_wakeup.set()
+    else:
+        _game_deadlines.pop(event_id, None)
+        _ticking_events.discard(event_id)
+    _scheduler_wakeup.set()
+
+def _load_game_deadlines():
+    """Jednorazowe wczytanie uruchomionych gier z bazy (start procesu)"""
+    active_events = db.session.query(GameState.event_id).filter_by(
+        key='game_active',
+        value='True'
+    ).distinct().all()
+    for (event_id,) in active_events:
+        schedule_game_deadline(event_id)
+    print(f"📅 Scheduled deadlines for {len(_game_deadlines)} running events")
+
+def finish_game(event_id):
+    """Kończy grę po upływie czasu"""
+    room_name = f'event_{event_id}'
+    print(f"⏰ TIME'S UP for event {event_id}!")
+    set_game_states(event_id, {'game_active': 'False', 'is_timer_running': 'False'})
+    schedule_game_deadline(event_id)
+    emit_full_state_update(room_name)
+    socketio.emit('game_over', {}, room=room_name)
+
 def update_timers():
-    """Background task that sends timer updates every second"""
+    """Background task - harmonogram końca gier (śpi do najbliższego terminu)"""
     print("🚀 Timer background task started")
 
-    last_tick_times = {}  # Śledzi ostatni czas tick'a dla każdego eventu
-    tick_count = 0  # Licznik tick'ów dla debugowania
+    if _is_timer_leader:
+        with app.app_context():
+            try:
+                _load_game_deadlines()
+            except Exception as e:
+                print(f"❌ Błąd wczytywania terminów gier: {e}")
 
     while True:
         try:
+            if not _is_timer_leader:
+                # Inny proces jest liderem - czekaj na przejęcie roli
+                _scheduler_wakeup.wait(timeout=TIMER_LEADER_TTL)
+                _scheduler_wakeup.clear()
+                continue
+
+            # Usuń nieaktualne wpisy z kopca
+            while _deadline_heap and _game_deadlines.get(_deadline_heap[0][1]) != _deadline_heap[0][0]:
+                heapq.heappop(_deadline_heap)
+
+            if not _deadline_heap:
+                # Brak uruchomionych gier - czekaj na zmianę stanu, bez zapytań do bazy
+                _scheduler_wakeup.wait()
+                _scheduler_wakeup.clear()
+                continue
+
+            end_time, event_id = _deadline_heap[0]
+            wait_seconds = (end_time - datetime.utcnow()).total_seconds()
+            if wait_seconds > 0:
+                _scheduler_wakeup.wait(timeout=wait_seconds)
+                _scheduler_wakeup.clear()
+                continue
+
+            heapq.heappop(_deadline_heap)
+            _game_deadlines.pop(event_id, None)
             with app.app_context():
-                # Znajdź wszystkie aktywne eventy
-                active_events = db.session.query(GameState.event_id).filter_by(
-                    key='game_active',
-                    value='True'
-                ).distinct().all()
-                event_ids = [e[0] for e in active_events]
-
-                # Debug co 10 sekund
-                tick_count += 1
-                if tick_count % 10 == 0:
-                    print(f"🔍 Timer tick #{tick_count}: Found {len(event_ids)} active events: {event_ids}")
-
-                current_time = datetime.utcnow()
-
-                for event_id in event_ids:
-                    is_running = get_game_state(event_id, 'is_timer_running', 'False')
-                    
-                    if is_running == 'True':
-                        # Pobierz time_speed dla tego eventu
-                        time_speed = int(get_game_state(event_id, 'time_speed', 1))
-                        
-                        # Oblicz ile czasu upłynęło od ostatniego tick'a
-                        if event_id in last_tick_times:
-                            elapsed_real_time = (current_time - last_tick_times[event_id]).total_seconds()
-                        else:
-                            elapsed_real_time = 1.0  # Pierwszy tick
-                        
-                        last_tick_times[event_id] = current_time
-                        
-                        # Oblicz ile czasu "game time" upłynęło (uwzględniając prędkość)
-                        elapsed_game_time = elapsed_real_time * time_speed
-                        
-                        # Pobierz aktualny game_end_time
-                        end_time_str = get_game_state(event_id, 'game_end_time')
-                        if end_time_str:
-                            end_time = datetime.fromisoformat(end_time_str)
-                            
-                            # Nowy end_time = stary end_time - (elapsed_game_time - elapsed_real_time)
-                            # To powoduje, że czas "przyspiesza"
-                            time_adjustment = elapsed_game_time - elapsed_real_time
-                            new_end_time = end_time - timedelta(seconds=time_adjustment)
-                            
-                            # Zapisz nowy end_time
-                            set_game_state(event_id, 'game_end_time', new_end_time.isoformat())
-                            
-                            # Oblicz pozostały czas
-                            time_left = max(0, (new_end_time - current_time).total_seconds())
-                        else:
-                            time_left = 0
-                        
-                        state = get_full_game_state(event_id)
-                        room_name = f'event_{event_id}'
-                        
-                        # Emit timer tick
-                        socketio.emit('timer_tick', {
-                            'time_left': time_left,
-                            'time_elapsed': state['time_elapsed'],
-                            'time_elapsed_with_pauses': state['time_elapsed_with_pauses']
-                        }, room=room_name)
-                        
-                        if event_ids:  # Log tylko jeśli są aktywne eventy
-                            print(f"⏱️  Tick -> {room_name}: {time_left:.1f}s left (speed: x{time_speed})")
-                        
-                        # Sprawdź czy czas minął
-                        if time_left <= 0:
-                            print(f"⏰ TIME'S UP for event {event_id}!")
-                            set_game_state(event_id, 'game_active', 'False')
-                            set_game_state(event_id, 'is_timer_running', 'False')
-                            emit_full_state_update(room_name)
-                            socketio.emit('game_over', {}, room=room_name)
-                            # Usuń z last_tick_times
-                            if event_id in last_tick_times:
-                                del last_tick_times[event_id]
-                    else:
-                        # Jeśli timer nie jest uruchomiony, usuń z last_tick_times
-                        if event_id in last_tick_times:
-                            del last_tick_times[event_id]
-                            
+                if compute_time_left(event_id) <= 0:
+                    finish_game(event_id)
+                else:
+                    # Stan zmienił się bez przebudowy harmonogramu - zaplanuj ponownie
+                    schedule_game_deadline(event_id)
+
         except Exception as e:
             print(f"❌ Błąd w update_timers: {e}")
             import traceback
             traceback.print_exc()
-        
-        # Sleep 1 second between updates
-        socketio.sleep(1)
+            socketio.sleep(1)
+
+def emit_timer_ticks():
+    """Background task - synchronizacja zegara (timer_tick) co TIMER_SYNC_INTERVAL sekund.
+
+    Klienci odliczają czas lokalnie z game_end_timestamp/time_speed, więc tick służy
+    tylko do korekty dryfu. Zmiany stanu wysyłane są od razu przez game_state_update.
+    """
+    print("🚀 Timer tick task started")
+
+    tick_count = 0  # Licznik tick'ów dla debugowania
+
+    while True:
+        try:
+            if not _ticking_events or not _is_timer_leader:
+                _ticker_wakeup.wait(timeout=None if _is_timer_leader else TIMER_LEADER_TTL)
+                _ticker_wakeup.clear()
+                continue
+
+            tick_count += 1
+            if tick_count % 10 == 0:
+                print(f"🔍 Timer sync #{tick_count}: {len(_ticking_events)} running events: {sorted(_ticking_events)}")
+
+            current_time = datetime.utcnow()
+            with app.app_context():
+                for event_id in list(_ticking_events):
+                    socketio.emit('timer_tick', timer_sync_payload(event_id, current_time), room=f'event_{event_id}')
+        except Exception as e:
+            print(f"❌ Błąd w emit_timer_ticks: {e}")
+            import traceback
+            traceback.print_exc()
+
+        socketio.sleep(app.config['TIMER_SYNC_INTERVAL'])
+
+# --- Rozgrzewka procesu (warm-up) ---
+# Po wybudzeniu maszyny (auto_start_machines) kompiluje szablony, otwiera pulę połączeń i ładuje
+# cache dzisiejszych eventów, zanim przyjdzie pierwszy skan. /health zwraca 503 do końca rozgrzewki.
+WARMUP_DB_CONNECTIONS = max(1, int(os.environ.get('WARMUP_DB_CONNECTIONS', 5)))
+_warmup = {'status': 'cold', 'steps': {}, 'events': [], 'error': None}
+
+def _warm_templates():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def _warm_db_pool():
+    pool_size = getattr(db.engine.pool, 'size', lambda: WARMUP_DB_CONNECTIONS)()
+    connections = [db.engine.connect() for _ in range(min(pool_size, WARMUP_DB_CONNECTIONS))]
+    try:
+        for connection in connections:
+            connection.execute(db.text('SELECT 1'))
+    finally:
+        for connection in connections:
+            connection.close()
+
+def _warm_event_caches():
+    # Serwer działa w UTC - okno ±1 dzień obejmuje event trwający po północy czasu lokalnego
+    today = datetime.utcnow().date()
+    event_ids = [event_id for event_id, in db.session.query(Event.id).filter(
+        Event.event_date.between(today - timedelta(days=1), today + timedelta(days=1)))]
+    for event_id in event_ids:
+        get_full_game_state(event_id)
+        leaderboard_snapshot(event_id)
+        _qr_code_cache[event_id] = _load_qr_codes(event_id)
+    _get_ai_catalog()
+    _warmup['events'] = event_ids
+
+def warm_up():
+    """Rozgrzewa proces: szablony, pula DB, stan/ranking/kody QR dzisiejszych eventów i katalog AI"""
+    _warmup['status'] = 'warming'
+    started = datetime.utcnow()
+    with app.app_context():
+        try:
+            for name, step in (('templates', _warm_templates), ('db_pool', _warm_db_pool), ('events', _warm_event_caches)):
+                step_started = datetime.utcnow()
+                step()
+                _warmup['steps'][name] = round((datetime.utcnow() - step_started).total_seconds() * 1000, 1)
+            print(f"🔥 Warm-up done in {(datetime.utcnow() - started).total_seconds():.2f}s: {_warmup['steps']}, "
+                  f"events {_warmup['events']}")
+        except Exception as e:
+            # Nieudana rozgrzewka nie blokuje ruchu - cache załadują się przy pierwszych żądaniach
+            _warmup['error'] = str(e)
+            print(f"❌ Warm-up error: {e}")
+        finally:
+            db.session.remove()
+    _warmup['status'] = 'ready'
+
+def start_warm_up():
+    """Uruchamia rozgrzewkę w tle (gunicorn post_worker_init / python app.py)"""
+    if _warmup['status'] != 'cold':
+        return
+    _warmup['status'] = 'warming'
+    socketio.start_background_task(target=warm_up)
 
 def init_background_tasks():
     """Initialize background tasks - called once per worker"""
@@ -2482,8 +4268,24 @@ def init_background_tasks():
     print("=" * 60)
 
     try:
-        print("📡 Starting timer background task...")
+        print("📡 Starting timer background tasks...")
         socketio.start_background_task(target=update_timers)
+        socketio.start_background_task(target=emit_timer_ticks)
+        if message_queue:
+            print(f"🔗 Multi-worker mode via {message_queue.split('@')[-1]}")
+            socketio.start_background_task(target=cluster_listener)
+            socketio.start_background_task(target=timer_leader_election)
+        for _ in range(AI_GENERATION_WORKERS):
+            socketio.start_background_task(target=generation_worker)
+        if not message_queue:
+            # Bez kolejki wiadomości jest jeden proces; w klastrze wznawia lider (timer_leader_election)
+            try:
+                with app.app_context():
+                    resume_generation_jobs()
+            except Exception as e:
+                print(f"❌ Nie udało się wznowić zadań generowania: {e}")
+        for _ in range(PHOTO_WORKERS):
+            socketio.start_background_task(target=photo_worker)
         _background_task_started = True
         print("✅ Background task started successfully")
     except Exception as e:
@@ -2508,8 +4310,10 @@ def on_join(data):
     if event_id:
         room = f'event_{event_id}'
         join_room(room)
+        if session.get('host_event_id') == _state_event_id(event_id):
+            join_room(f'host_{event_id}')
         emit('game_state_update', get_full_game_state(event_id), room=request.sid)
-        emit_leaderboard_update(room)
+        emit('leaderboard_update', leaderboard_snapshot(event_id), room=request.sid)
 
 # Uruchomienie Aplikacji
 if __name__ == '__main__':
@@ -2517,8 +4321,8 @@ if __name__ == '__main__':
     print("🚀 SAPER QR APPLICATION STARTING")
     print("=" * 60)
     
-    print("📡 Starting timer background task...")
-    socketio.start_background_task(target=update_timers)
+    init_background_tasks()
+    start_warm_up()
     
     port = int(os.environ.get('PORT', 5000))
     debug_mode = os.environ.get('DEBUG', 'False').lower() == 'true'
@@ -1,9 +1,16 @@
 # Gunicorn configuration for SAPER QR
 import multiprocessing
+import os
 
 # Worker configuration
 worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
-workers = 1  # Musi być 1 dla Socket.IO z background tasks
+# Wiele workerów tylko z kolejką wiadomości Socket.IO (SOCKETIO_MESSAGE_QUEUE=redis://...):
+# emisje idą przez Redis, a zadania zegara działają tylko w procesie-liderze.
+# Bez kolejki musi być 1 worker.
+if os.environ.get('SOCKETIO_MESSAGE_QUEUE'):
+    workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+else:
+    workers = 1
 bind = '0.0.0.0:8080'
 timeout = 120
 keepalive = 5
@@ -18,9 +25,10 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 def post_worker_init(worker):
     """
     Called after a worker has been forked.
-    This is where we start the background task for Socket.IO timers.
+    This is where we start the background task for Socket.IO timers
+    and the warm-up (templates, DB pool, today's events) reported by /health.
     """
-    from app import init_background_tasks
+    from app import init_background_tasks, start_warm_up
     import logging
 
     logger = logging.getLogger('gunicorn.error')
@@ -30,6 +38,7 @@ def post_worker_init(worker):
 
     try:
         init_background_tasks()
+        start_warm_up()
         logger.info('✅ Background tasks initialized successfully')
     except Exception as e:
         logger.error(f'❌ Failed to initialize background tasks: {e}')
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Generator obciążenia dla SAPER QR - symuluje setki graczy jednocześnie.
+
+Każdy wirtualny gracz rejestruje się przez /api/player/register, dołącza do pokoju
+event_{id} przez Socket.IO i odtwarza typową ścieżkę gry:
+scan_qr (biały/żółty) -> answer -> ai-quiz -> scan_qr (zielony) -> minigame/complete.
+
+Raport: p50/p95/p99 czasu odpowiedzi per endpoint, odsetek błędów oraz opóźnienie
+broadcastu (od wysłania żądania zmieniającego wynik do odebrania leaderboard_delta/update
+z nowym wynikiem gracza).
+
+Uruchomienie (serwer lokalnie na SQLite lub Postgres):
+
+    DATABASE_URL=sqlite:////tmp/loadtest.db python app.py
+    pip install -r loadtest/requirements.txt
+    python -m loadtest --url http://localhost:5000 --players 300 --setup
+"""
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark indeksów: czas scan_qr / answer na bazie z wieloma historycznymi eventami.
+
+Wypełnia bazę historią (eventy, gracze, pytania, kody QR, skany, odpowiedzi),
+mierzy endpointy gracza bez indeksów, uruchamia migrację ensure_indexes()
+i mierzy ponownie.
+
+    python -m loadtest.db_benchmark --events 300 --players 60 --samples 300
+
+Domyślnie używa tymczasowej bazy SQLite. --database-url pozwala wskazać pustą
+bazę Postgres (tabele zostaną utworzone i wypełnione danymi testowymi).
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from loadtest.runner import percentile
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m loadtest.db_benchmark', description='Benchmark indeksów SAPER QR')
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--events', type=int, default=300, help='liczba historycznych eventów')
+    parser.add_argument('--players', type=int, default=60, help='graczy na event')
+    parser.add_argument('--questions', type=int, default=40, help='pytań na event')
+    parser.add_argument('--scans', type=int, default=4, help='skanów na gracza')
+    parser.add_argument('--answers', type=int, default=8, help='odpowiedzi na gracza')
+    parser.add_argument('--samples', type=int, default=300, help='par scan/answer na pomiar')
+    return parser.parse_args(argv)
+
+
+def seed_history(saper, args):
+    """Wstawia historyczne eventy paczkami przez Core insert"""
+    db = saper.db
+    now = datetime.utcnow()
+    first_event = (db.session.query(db.func.max(saper.Event.id)).scalar() or 0) + 1
+    player_id = (db.session.query(db.func.max(saper.Player.id)).scalar() or 0) + 1
+    question_id = (db.session.query(db.func.max(saper.Question.id)).scalar() or 0) + 1
+    qr_id = (db.session.query(db.func.max(saper.QRCode.id)).scalar() or 0) + 1
+    password_hash = saper.generate_password_hash('benchmark')
+
+    for event_id in range(first_event, first_event + args.events):
+        players, questions, codes, scans, answers = [], [], [], [], []
+        event_questions = list(range(question_id, question_id + args.questions))
+        for i in range(args.questions):
+            questions.append({
+                'id': question_id + i, 'text': f'Pytanie {i}?', 'option_a': 'A', 'option_b': 'B', 'option_c': 'C',
+                'correct_answer': 'A', 'letter_to_reveal': 'S', 'event_id': event_id,
+                'category': 'company' if i % 2 == 0 else 'world', 'difficulty': 'easy',
+                'times_shown': 0, 'times_correct': 0
+            })
+        question_id += args.questions
+        event_codes = []
+        for identifier, color in [('bialy', 'white'), ('zolty', 'yellow')] + \
+                [(f'czerwony{i}', 'red') for i in range(1, 21)] + [(f'zielony{i}', 'green') for i in range(1, 6)]:
+            codes.append({'id': qr_id, 'code_identifier': identifier, 'color': color, 'event_id': event_id})
+            event_codes.append((qr_id, color))
+            qr_id += 1
+        for _ in range(args.players):
+            players.append({'id': player_id, 'name': f'Gracz {player_id}', 'score': random.randint(0, 300),
+                            'warnings': 0, 'revealed_letters': '', 'event_id': event_id})
+            for _ in range(args.scans):
+                code_id, color = random.choice(event_codes)
+                scans.append({'player_id': player_id, 'qrcode_id': code_id, 'event_id': event_id,
+                              'color_category': color, 'scan_time': now - timedelta(days=random.randint(1, 365))})
+            for answered in random.sample(event_questions, min(args.answers, len(event_questions))):
+                answers.append({'player_id': player_id, 'question_id': answered, 'event_id': event_id})
+            player_id += 1
+
+        db.session.execute(db.insert(saper.Event), [{
+            'id': event_id, 'name': f'Event #{event_id}', 'login': f'bench{event_id}', 'password_hash': password_hash
+        }])
+        for model, rows in ((saper.Player, players), (saper.Question, questions), (saper.QRCode, codes),
+                            (saper.PlayerScan, scans), (saper.PlayerAnswer, answers)):
+            db.session.execute(db.insert(model), rows)
+        db.session.commit()
+
+
+def prepare_live_event(saper, args):
+    """Event 1 z aktywną grą i świeżymi graczami dla obu pomiarów"""
+    db = saper.db
+    event_id = 1
+    db.session.execute(db.insert(saper.Question), [{
+        'text': f'Pytanie na żywo {i}?', 'option_a': 'A', 'option_b': 'B', 'option_c': 'C',
+        'correct_answer': 'A', 'letter_to_reveal': 'S', 'event_id': event_id,
+        'category': 'company' if i % 2 == 0 else 'world', 'difficulty': 'easy', 'times_shown': 0, 'times_correct': 0
+    } for i in range(args.questions)])
+    db.session.execute(db.insert(saper.QRCode), [
+        {'code_identifier': 'bialy', 'color': 'white', 'event_id': event_id},
+        {'code_identifier': 'zolty', 'color': 'yellow', 'event_id': event_id},
+    ])
+    players = [saper.Player(name=f'Benchmark {i}', score=0, event_id=event_id) for i in range(2 * args.samples)]
+    db.session.add_all(players)
+    db.session.commit()
+    saper.set_game_states(event_id, {'game_active': 'True', 'is_timer_running': 'True'})
+    return event_id, [player.id for player in players]
+
+
+def drop_indexes(saper):
+    inspector = saper.db.inspect(saper.db.engine)
+    for table in saper.db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(bind=saper.db.engine)
+
+
+def measure(client, event_id, player_ids):
+    timings = {'scan_qr': [], 'answer': []}
+    for player_id in player_ids:
+        code = random.choice(['bialy', 'zolty'])
+        started = time.perf_counter()
+        response = client.post('/api/player/scan_qr', json={'player_id': player_id, 'qr_code': code, 'event_id': event_id})
+        timings['scan_qr'].append(time.perf_counter() - started)
+        data = response.get_json() or {}
+        if data.get('status') != 'question':
+            continue
+        started = time.perf_counter()
+        client.post('/api/player/answer', json={'player_id': player_id, 'question_id': data['question']['id'],
+                                                'answer': random.choice('ABC')})
+        timings['answer'].append(time.perf_counter() - started)
+    return timings
+
+
+def print_timings(label, timings):
+    for name, values in timings.items():
+        print(f'{label:<16}{name:<10}{len(values):>7}{percentile(values, 50) * 1000:>10.2f}'
+              f'{percentile(values, 95) * 1000:>10.2f}{percentile(values, 99) * 1000:>10.2f}')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='saper-bench-'), 'bench.sqlite3')
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+
+    import app as saper
+
+    with saper.app.app_context():
+        started = time.perf_counter()
+        seed_history(saper, args)
+        event_id, player_ids = prepare_live_event(saper, args)
+        print(f'Seeded {args.events} events x {args.players} players in {time.perf_counter() - started:.1f}s '
+              f'({saper.PlayerScan.query.count()} scans, {saper.PlayerAnswer.query.count()} answers)')
+
+        client = saper.app.test_client()
+        print(f'{"":<16}{"endpoint":<10}{"count":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        with contextlib.redirect_stdout(io.StringIO()):
+            drop_indexes(saper)
+            without = measure(client, event_id, player_ids[:args.samples])
+            started = time.perf_counter()
+            saper.ensure_indexes()
+            migration_time = time.perf_counter() - started
+            indexed = measure(client, event_id, player_ids[args.samples:])
+        print_timings('without indexes', without)
+        print_timings('with indexes', indexed)
+        print(f'ensure_indexes() migration took {migration_time:.2f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Lokalna atrapa Anthropic Messages API (streaming SSE) do testów generowania pytań AI.
+
+    python -m loadtest.fake_anthropic --port 8765 --delay 0.2
+    ANTHROPIC_BASE_URL=http://localhost:8765 ANTHROPIC_API_KEY=test python app.py
+
+Odpowiada na POST /v1/messages tablicą JSON z pytaniami, wysyłaną w małych
+fragmentach (text_delta) z opóźnieniem, żeby było widać zapis przyrostowy.
+"""
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_questions(topic, count):
+    return [{
+        'q': f'{topic}: pytanie testowe nr {i + 1}?',
+        'a': f'Odpowiedź A{i + 1}',
+        'b': f'Odpowiedź B{i + 1}',
+        'c': f'Odpowiedź C{i + 1}',
+        'correct': 'ABC'[i % 3]
+    } for i in range(count)]
+
+
+class FakeAnthropicHandler(BaseHTTPRequestHandler):
+    delay = 0.2
+    chunk_size = 40
+    fail = False
+
+    def _send_event(self, name, data):
+        self.wfile.write(f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if not self.path.startswith('/v1/messages'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.fail:
+            self.send_response(529)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'Overloaded'}}).encode())
+            return
+
+        prompt = body['messages'][0]['content']
+        match = re.search(r'Generate (\d+) quiz questions about: (.+)', prompt)
+        count, topic = (int(match.group(1)), match.group(2).strip()) if match else (10, 'Temat')
+        text = json.dumps(fake_questions(topic, count), ensure_ascii=False, indent=2)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self._send_event('message_start', {'type': 'message_start', 'message': {
+            'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': body.get('model', 'fake'),
+            'content': [], 'stop_reason': None, 'stop_sequence': None,
+            'usage': {'input_tokens': len(prompt) // 4, 'output_tokens': 0}
+        }})
+        self._send_event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                                 'content_block': {'type': 'text', 'text': ''}})
+        for start in range(0, len(text), self.chunk_size):
+            self._send_event('content_block_delta', {'type': 'content_block_delta', 'index': 0, 'delta': {
+                'type': 'text_delta', 'text': text[start:start + self.chunk_size]
+            }})
+            time.sleep(self.delay)
+        self._send_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        self._send_event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                           'usage': {'output_tokens': len(text) // 4}})
+        self._send_event('message_stop', {'type': 'message_stop'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m loadtest.fake_anthropic')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0.2, help='opóźnienie (s) między fragmentami')
+    parser.add_argument('--chunk-size', type=int, default=40)
+    parser.add_argument('--fail', action='store_true', help='zwracaj błąd 529 (overloaded)')
+    args = parser.parse_args(argv)
+    FakeAnthropicHandler.delay = args.delay
+    FakeAnthropicHandler.chunk_size = args.chunk_size
+    FakeAnthropicHandler.fail = args.fail
+    print(f'Fake Anthropic API on http://localhost:{args.port}')
+    ThreadingHTTPServer(('', args.port), FakeAnthropicHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Scenariusz wirtualnego gracza, przygotowanie eventu i raport z testu obciążenia"""
+import argparse
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+import socketio
+
+
+class Stats:
+    """Zbiera czasy odpowiedzi, błędy i opóźnienia broadcastów (bezpieczne wątkowo)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.broadcast_lag = []
+        self.broadcasts_missed = 0
+        self.players_failed = 0
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def record_broadcast(self, seconds):
+        with self.lock:
+            self.broadcast_lag.append(seconds)
+
+    def record_missed(self, count=1):
+        with self.lock:
+            self.broadcasts_missed += count
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class VirtualPlayer:
+    """Jeden gracz: własna sesja HTTP i własne połączenie Socket.IO"""
+
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.url = args.url.rstrip('/')
+        self.http = requests.Session()
+        self.sio = socketio.Client(reconnection=False)
+        self.player_id = None
+        self.score = 0
+        # Oczekiwane wyniki w broadcastach: score -> moment wysłania żądania
+        self.pending_scores = {}
+        self.pending_lock = threading.Lock()
+        self.sio.on('leaderboard_update', self._on_leaderboard_snapshot)
+        self.sio.on('leaderboard_delta', self._on_leaderboard_delta)
+
+    # --- HTTP ---
+    def call(self, name, path, payload=None, method='POST', expected=(200,)):
+        started = time.perf_counter()
+        status, data = None, None
+        try:
+            response = self.http.request(method, self.url + path, json=payload, timeout=self.args.timeout)
+            status = response.status_code
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                data = response.json()
+        except requests.RequestException:
+            pass
+        self.stats.record(name, time.perf_counter() - started, status in expected)
+        return status, data, started
+
+    def think(self):
+        time.sleep(random.uniform(self.args.think_min, self.args.think_max))
+
+    # --- Broadcasty rankingu ---
+    def expect_score(self, new_score, sent_at):
+        if new_score is None or new_score == self.score:
+            return
+        self.score = new_score
+        with self.pending_lock:
+            self.pending_scores[new_score] = sent_at
+
+    def _seen_score(self, score):
+        with self.pending_lock:
+            sent_at = self.pending_scores.pop(score, None)
+            # Starsze oczekiwane wyniki zostały nadpisane nowszym broadcastem
+            stale = [s for s, t in self.pending_scores.items() if sent_at is not None and t < sent_at]
+            for s in stale:
+                self.pending_scores.pop(s)
+        if sent_at is not None:
+            self.stats.record_broadcast(time.perf_counter() - sent_at)
+
+    def _on_leaderboard_snapshot(self, players):
+        for player in players or []:
+            if player.get('id') == self.player_id:
+                self._seen_score(player.get('score'))
+
+    def _on_leaderboard_delta(self, delta):
+        for player in delta.get('changes', []):
+            if player.get('id') == self.player_id:
+                self._seen_score(player.get('score'))
+
+    def wait_for_broadcasts(self):
+        deadline = time.time() + self.args.broadcast_timeout
+        while time.time() < deadline:
+            with self.pending_lock:
+                if not self.pending_scores:
+                    return
+            time.sleep(0.05)
+        with self.pending_lock:
+            self.stats.record_missed(len(self.pending_scores))
+            self.pending_scores.clear()
+
+    # --- Scenariusz ---
+    def register(self):
+        name = f'{self.args.name_prefix}{self.index}-{random.randint(1000, 9999)}'
+        status, data, _ = self.call('register', '/api/player/register', {'name': name, 'event_id': self.args.event_id})
+        if status != 200 or not data:
+            raise RuntimeError(f'registration failed ({status})')
+        self.player_id = data['id']
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            self.sio.connect(self.url, transports=['websocket'], wait_timeout=self.args.timeout)
+            self.sio.emit('join', {'event_id': self.args.event_id})
+            self.stats.record('socket_connect', time.perf_counter() - started, True)
+        except Exception:
+            self.stats.record('socket_connect', time.perf_counter() - started, False)
+            raise
+
+    def quiz_scan(self, code):
+        status, data, _ = self.call('scan_qr', '/api/player/scan_qr', {
+            'player_id': self.player_id, 'qr_code': code, 'event_id': self.args.event_id
+        }, expected=(200, 429))
+        if status != 200 or not data or data.get('status') != 'question':
+            return
+        self.think()
+        status, data, sent_at = self.call('answer', '/api/player/answer', {
+            'player_id': self.player_id,
+            'question_id': data['question']['id'],
+            'answer': random.choice('ABC')
+        })
+        if status == 200 and data:
+            self.expect_score(data.get('score'), sent_at)
+
+    def ai_quiz(self):
+        status, categories, _ = self.call('ai_categories', f'/api/player/ai-quiz/categories/{self.args.event_id}',
+                                          method='GET')
+        if status != 200 or not categories:
+            return
+        for _ in range(self.args.ai_questions):
+            category = random.choice(categories)
+            status, question, _ = self.call('ai_question', '/api/player/ai-quiz/question', {
+                'player_id': self.player_id, 'category_id': category['id'], 'event_id': self.args.event_id
+            }, expected=(200, 404))
+            if status != 200 or not question:
+                continue
+            self.think()
+            status, data, sent_at = self.call('ai_answer', '/api/player/ai-quiz/answer', {
+                'player_id': self.player_id,
+                'question_id': question['question_id'],
+                'answer': random.choice('ABC'),
+                'event_id': self.args.event_id
+            })
+            if status == 200 and data:
+                self.expect_score(data.get('total_score'), sent_at)
+
+    def minigame(self):
+        code = f'zielony{random.randint(1, self.args.green_codes)}'
+        status, data, _ = self.call('scan_qr', '/api/player/scan_qr', {
+            'player_id': self.player_id, 'qr_code': code, 'event_id': self.args.event_id
+        }, expected=(200, 404))
+        if status != 200 or not data or data.get('status') != 'minigame':
+            return
+        self.think()
+        status, data, sent_at = self.call('minigame_complete', '/api/player/minigame/complete', {
+            'player_id': self.player_id, 'game_type': data['game'], 'score': 20
+        })
+        if status == 200 and data:
+            self.expect_score(data.get('total_score'), sent_at)
+
+    def run(self):
+        try:
+            self.register()
+            self.connect()
+            for _ in range(self.args.rounds):
+                # Kody biały/żółty mają 5 min blokady - kolejne rundy dostaną 429 (oczekiwane)
+                self.quiz_scan('bialy')
+                self.think()
+                self.quiz_scan('zolty')
+                self.think()
+                self.ai_quiz()
+                self.think()
+                self.minigame()
+                self.think()
+            self.wait_for_broadcasts()
+        except Exception as e:
+            with self.stats.lock:
+                self.stats.players_failed += 1
+            print(f'  player {self.index}: {e}', file=sys.stderr)
+        finally:
+            if self.sio.connected:
+                self.sio.disconnect()
+
+
+def setup_event(args):
+    """Przygotowuje event: pytania AI, kody QR, pytania quizu i start gry"""
+    url = args.url.rstrip('/')
+    admin = requests.Session()
+    admin.post(url + '/admin/login', data={'login': args.admin_login, 'password': args.admin_password})
+    admin.post(url + '/api/admin/ai-quiz/load-questions')
+    response = admin.post(url + '/api/admin/qrcodes/generate', json={
+        'event_id': args.event_id, 'counts': {'green': args.green_codes, 'red': args.players, 'white_trap': args.players}
+    })
+    print(f'QR codes: {response.status_code}')
+
+    host = requests.Session()
+    host.post(url + '/host/login', data={'login': args.host_login, 'password': args.host_password})
+    for i in range(args.questions):
+        host.post(url + '/api/host/questions', json={
+            'text': f'Pytanie testowe {i}?',
+            'answers': ['A', 'B', 'C'],
+            'correctAnswer': random.choice('ABC'),
+            'category': 'company' if i % 2 == 0 else 'world'
+        })
+    response = host.post(url + '/api/host/start_game', json={'minutes': args.minutes})
+    print(f'Start game: {response.status_code}')
+    if response.status_code != 200:
+        raise SystemExit('Nie udało się wystartować gry - sprawdź dane logowania hosta')
+
+
+def print_report(stats, duration, players):
+    total = sum(len(v) for v in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print()
+    print('=' * 78)
+    print(f'Players: {players}  failed: {stats.players_failed}  duration: {duration:.1f}s  '
+          f'requests: {total}  ({total / duration if duration else 0:.1f} req/s)')
+    print('=' * 78)
+    print(f'{"endpoint":<20}{"count":>8}{"errors":>8}{"err %":>8}{"p50 ms":>11}{"p95 ms":>11}{"p99 ms":>11}')
+    for name in sorted(stats.latencies):
+        values = stats.latencies[name]
+        err = stats.errors[name]
+        print(f'{name:<20}{len(values):>8}{err:>8}{100 * err / len(values):>8.1f}'
+              f'{percentile(values, 50) * 1000:>11.1f}{percentile(values, 95) * 1000:>11.1f}'
+              f'{percentile(values, 99) * 1000:>11.1f}')
+    lag = stats.broadcast_lag
+    print('-' * 78)
+    print(f'{"broadcast lag":<20}{len(lag):>8}{stats.broadcasts_missed:>8}{"":>8}'
+          f'{percentile(lag, 50) * 1000:>11.1f}{percentile(lag, 95) * 1000:>11.1f}{percentile(lag, 99) * 1000:>11.1f}')
+    print(f'Error rate: {100 * errors / total if total else 0:.2f}%  '
+          f'(broadcast lag = score-changing request sent -> leaderboard broadcast received; errors column = missed)')
+    return errors / total if total else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m loadtest', description='Test obciążenia SAPER QR')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--event-id', type=int, default=1)
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=2, help='liczba przejść scenariusza na gracza')
+    parser.add_argument('--ramp-up', type=float, default=10.0, help='czas (s) na uruchomienie wszystkich graczy')
+    parser.add_argument('--think-min', type=float, default=0.2)
+    parser.add_argument('--think-max', type=float, default=1.5)
+    parser.add_argument('--ai-questions', type=int, default=3, help='pytania AI na rundę')
+    parser.add_argument('--green-codes', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--broadcast-timeout', type=float, default=5.0)
+    parser.add_argument('--name-prefix', default='lt-')
+    parser.add_argument('--setup', action='store_true', help='przygotuj event i wystartuj grę przed testem')
+    parser.add_argument('--questions', type=int, default=40)
+    parser.add_argument('--minutes', type=int, default=30)
+    parser.add_argument('--admin-login', default='admin')
+    parser.add_argument('--admin-password', default='admin')
+    parser.add_argument('--host-login', default='host1')
+    parser.add_argument('--host-password', default='password1')
+    parser.add_argument('--max-error-rate', type=float, default=None,
+                        help='zakończ z kodem 1, jeśli odsetek błędów (0-1) jest większy')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.setup:
+        setup_event(args)
+
+    stats = Stats()
+    players = [VirtualPlayer(i, args, stats) for i in range(args.players)]
+    threads = [threading.Thread(target=p.run, daemon=True) for p in players]
+    delay = args.ramp_up / max(len(threads), 1)
+
+    print(f'Starting {len(threads)} players against {args.url} (event {args.event_id})...')
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+        time.sleep(delay)
+    for thread in threads:
+        thread.join()
+    error_rate = print_report(stats, time.perf_counter() - started, len(players))
+
+    if args.max_error_rate is not None and error_rate > args.max_error_rate:
+        return 1
+    return 0
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Profil zimnego startu: czas importu app.py (python -X importtime) i czas od uruchomienia
+procesu do pierwszej odpowiedzi HTTP, w trybie domyślnym i z LAZY_STARTUP=true.
+
+    python -m loadtest.startup_profile --runs 3 --top 12
+
+Domyślnie używa tymczasowej bazy SQLite (tworzonej raz przez `flask init-db`, jak
+release_command przed startem maszyn). --database-url pozwala wskazać inną bazę.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m loadtest.startup_profile', description='Profil startu SAPER QR')
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--runs', type=int, default=3, help='powtórzeń każdego pomiaru')
+    parser.add_argument('--top', type=int, default=12, help='ile najdroższych importów pokazać')
+    parser.add_argument('--path', default='/health', help='ścieżka pierwszego żądania')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    return parser.parse_args(argv)
+
+
+def app_env(database_url, lazy):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONIOENCODING='utf-8')
+    env['LAZY_STARTUP'] = 'true' if lazy else 'false'
+    return env
+
+
+def import_profile(env):
+    """Czasy importu (µs) modułów ładowanych bezpośrednio przez app oraz własny czas app.py"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    modules, own, total = {}, 0, 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue  # nagłówek
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if name == 'app':
+            own, total = self_us, cumulative_us
+        elif depth == 1:
+            modules[name.split('.')[0]] = modules.get(name.split('.')[0], 0) + cumulative_us
+    return modules, own, total
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def first_response(env, path, timeout):
+    """Sekundy od uruchomienia `python app.py` do pierwszej odpowiedzi na path"""
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=dict(env, PORT=str(port)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                requests.get(f'http://127.0.0.1:{port}{path}', timeout=timeout)
+                return time.perf_counter() - started
+            except requests.ConnectionError:
+                time.sleep(0.02)
+        raise RuntimeError(f'serwer nie odpowiedział w {timeout}s')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='saper-startup-'), 'db.sqlite3')
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=ROOT, env=app_env(database_url, True),
+                   stdout=subprocess.DEVNULL, check=True)
+
+    summary = []
+    for label, lazy in (('default', False), ('LAZY_STARTUP', True)):
+        env = app_env(database_url, lazy)
+        modules, own, totals = defaultdict(list), [], []
+        for _ in range(args.runs):
+            run_modules, run_own, run_total = import_profile(env)
+            for name, value in run_modules.items():
+                modules[name].append(value)
+            own.append(run_own)
+            totals.append(run_total)
+        responses = [first_response(env, args.path, args.timeout) for _ in range(args.runs)]
+
+        print(f'\n{label}: import app (median of {args.runs})')
+        print(f'{"module":<28}{"ms":>10}')
+        ranked = sorted(modules.items(), key=lambda item: -sorted(item[1])[len(item[1]) // 2])
+        for name, values in ranked[:args.top]:
+            print(f'{name:<28}{sorted(values)[len(values) // 2] / 1000:>10.1f}')
+        print(f'{"app.py (own code)":<28}{sorted(own)[len(own) // 2] / 1000:>10.1f}')
+        summary.append((label, sorted(totals)[len(totals) // 2] / 1000, sorted(responses)[len(responses) // 2] * 1000))
+
+    print(f'\n{"mode":<16}{"import ms":>12}{"first response ms":>20}')
+    for label, import_ms, response_ms in summary:
+        print(f'{label:<16}{import_ms:>12.1f}{response_ms:>20.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
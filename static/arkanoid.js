@@ -387,14 +387,10 @@ class ArkanoidGame {
         
         // Wyślij wynik do serwera
         try {
-            const response = await fetch('/api/player/minigame/complete', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    player_id: this.playerId,
-                    game_type: 'arkanoid',
-                    score: this.score
-                })
+            const response = await postScoreRequest('/api/player/minigame/complete', {
+                player_id: this.playerId,
+                game_type: 'arkanoid',
+                score: this.score
             });
             
             const result = await response.json();